@@ -0,0 +1,195 @@
+import asyncio
+import math
+import re
+import time
+
+import orjson
+from cachetools import TTLCache
+
+from metrics import registry
+
+admission_rejected = registry.counter(
+    "admission_rejected_total", "Requests refused by admission control", ("route_class", "reason"))
+admission_in_flight = registry.gauge(
+    "admission_in_flight", "Requests holding an admission slot", ("route_class",))
+
+
+def parse_limits(spec: str) -> dict[str, tuple[int, float]]:
+    # "auth=8:2,heavy=4:5" -> {"auth": (8, 2.0), "heavy": (4, 5.0)}:
+    # concurrency limit and queueing latency budget in seconds per class
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, value = item.partition("=")
+        limit, _, budget = value.partition(":")
+        limits[name.strip()] = (int(limit), float(budget or 1))
+    return limits
+
+
+# ============= Limiters =============
+
+class ConcurrencyLimiter:
+    # At most `limit` requests of a class run at once; the rest queue. A
+    # request is refused up front when the expected wait (queue position x
+    # average service time / limit) exceeds the budget, and refused after
+    # waiting when no slot frees up within the budget.
+    def __init__(self, name: str, limit: int, budget: float):
+        self.name = name
+        self.limit = limit
+        self.budget = budget
+        self.active = 0
+        self.waiting = 0
+        self.avg_service = 0.05  # seconds, exponentially weighted
+        self._cond = asyncio.Condition()
+        self.stats = {"admitted": 0, "rejected_queue": 0, "rejected_timeout": 0}
+
+    def expected_wait(self) -> float:
+        return (self.waiting + 1) * self.avg_service / self.limit
+
+    async def acquire(self) -> bool:
+        if self.active < self.limit and not self.waiting:
+            self.active += 1
+            self.stats["admitted"] += 1
+            return True
+        if self.expected_wait() > self.budget:
+            self.stats["rejected_queue"] += 1
+            return False
+
+        self.waiting += 1
+        try:
+            async with self._cond:
+                await asyncio.wait_for(self._cond.wait_for(lambda: self.active < self.limit), self.budget)
+                self.active += 1
+        except asyncio.TimeoutError:
+            self.stats["rejected_timeout"] += 1
+            return False
+        finally:
+            self.waiting -= 1
+        self.stats["admitted"] += 1
+        return True
+
+    async def release(self, service_time: float):
+        self.avg_service = 0.8 * self.avg_service + 0.2 * service_time
+        async with self._cond:
+            self.active -= 1
+            # All waiters re-check: one may have timed out on a notify
+            self._cond.notify_all()
+
+    def snapshot(self) -> dict:
+        return {
+            "limit": self.limit,
+            "budget_seconds": self.budget,
+            "active": self.active,
+            "waiting": self.waiting,
+            "avg_service_ms": round(self.avg_service * 1000, 2),
+            **self.stats,
+        }
+
+
+class TokenBuckets:
+    # One bucket per key: `rate` tokens per second, up to `burst`
+    def __init__(self, rate: float, burst: float, max_keys: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        # Idle keys are forgotten once their bucket would be full again
+        self._buckets = TTLCache(maxsize=max_keys, ttl=max(burst / rate, 1))
+        self.rejected = 0
+
+    def take(self, key: str) -> float:
+        # 0 when admitted, otherwise seconds until a token is available
+        now = time.monotonic()
+        tokens, last = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now)
+            self.rejected += 1
+            return (1 - tokens) / self.rate
+        self._buckets[key] = (tokens - 1, now)
+        return 0.0
+
+
+# ============= Middleware =============
+
+class AdmissionControl:
+    # Requests are classified by method and path into route classes with
+    # their own ConcurrencyLimiter, and every /api request spends a token from
+    # its caller's bucket (key_func, e.g. the JWT sub). Refusals are
+    # immediate: 429 for a caller over its rate, 503 for a saturated class,
+    # both with Retry-After.
+    def __init__(self, routes: list[tuple[str, str, str]], limits: dict[str, tuple[int, float]],
+                 rate: float, burst: float, key_func, enabled: bool = True):
+        self.enabled = enabled
+        self.routes = [(method, re.compile(pattern), name) for method, pattern, name in routes]
+        self.limiters = {name: ConcurrencyLimiter(name, limit, budget) for name, (limit, budget) in limits.items()}
+        self.buckets = TokenBuckets(rate, burst) if rate > 0 else None
+        self.key_func = key_func
+
+    def classify(self, method: str, path: str) -> str:
+        for route_method, pattern, name in self.routes:
+            if route_method in (method, "*") and pattern.fullmatch(path):
+                return name
+        return "default"
+
+    def snapshot(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "classes": {name: limiter.snapshot() for name, limiter in self.limiters.items()},
+            "rate_limit": None if self.buckets is None else {
+                "rate": self.buckets.rate,
+                "burst": self.buckets.burst,
+                "tracked_keys": len(self.buckets._buckets),
+                "rejected": self.buckets.rejected,
+            },
+        }
+
+
+class AdmissionMiddleware:
+    def __init__(self, app, control: AdmissionControl):
+        self.app = app
+        self.control = control
+
+    async def __call__(self, scope, receive, send):
+        control = self.control
+        if not control.enabled or scope["type"] != "http" or not scope["path"].startswith("/api"):
+            await self.app(scope, receive, send)
+            return
+
+        route_class = control.classify(scope["method"], scope["path"])
+
+        if control.buckets is not None:
+            wait = control.buckets.take(control.key_func(scope))
+            if wait:
+                admission_rejected.inc(route_class, "rate")
+                await self._refuse(send, 429, "Too many requests", wait)
+                return
+
+        limiter = control.limiters.get(route_class)
+        if limiter is None:
+            await self.app(scope, receive, send)
+            return
+
+        if not await limiter.acquire():
+            admission_rejected.inc(route_class, "overloaded")
+            await self._refuse(send, 503, "Server busy, retry shortly", limiter.expected_wait())
+            return
+
+        admission_in_flight.inc(route_class)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            admission_in_flight.dec(route_class)
+            await limiter.release(time.perf_counter() - started)
+
+    @staticmethod
+    async def _refuse(send, status: int, detail: str, retry_after: float):
+        body = orjson.dumps({"detail": detail})
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
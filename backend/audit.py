@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import time
+
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindLog:
+    # Buffers documents in a bounded queue and inserts them in batches from a
+    # background task: a batch is flushed after batch_size entries or
+    # flush_interval seconds, whichever comes first. put() waits while the
+    # queue is full, so writers slow down instead of memory growing.
+    def __init__(self, collection, max_queue: int = 10000, batch_size: int = 500,
+                 flush_interval: float = 0.2, max_retries: int = 3):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._task = None
+        self.stats = {
+            "max_depth": 0,
+            "written": 0,
+            "dropped": 0,
+            "flushes": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "total_flush_ms": 0.0,
+        }
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Drain everything queued so far, then stop the flusher
+        if self._task is None:
+            return
+        await self.queue.join()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def put(self, doc: dict):
+        await self.queue.put(doc)
+        self.stats["max_depth"] = max(self.stats["max_depth"], self.queue.qsize())
+
+    def snapshot(self) -> dict:
+        flushes = self.stats["flushes"]
+        return {
+            "depth": self.queue.qsize(),
+            "capacity": self.queue.maxsize,
+            **self.stats,
+            "avg_flush_ms": self.stats["total_flush_ms"] / flushes if flushes else 0.0,
+        }
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._flush(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def _flush(self, batch: list):
+        started = time.perf_counter()
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                await self.collection.insert_many(batch, ordered=False)
+                self.stats["written"] += len(batch)
+                break
+            except BulkWriteError as e:
+                # Individual documents failed (e.g. duplicates); the rest are in
+                failed = len(e.details.get("writeErrors", []))
+                self.stats["written"] += len(batch) - failed
+                self.stats["dropped"] += failed
+                logger.error("Write-behind batch had %d failed documents", failed)
+                break
+            except Exception as e:
+                if attempt == self.max_retries:
+                    self.stats["dropped"] += len(batch)
+                    logger.error("Dropping %d write-behind documents after %d attempts: %s", len(batch), attempt, e)
+                    break
+                await asyncio.sleep(0.5 * attempt)
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.stats["flushes"] += 1
+        self.stats["last_flush_ms"] = elapsed_ms
+        self.stats["max_flush_ms"] = max(self.stats["max_flush_ms"], elapsed_ms)
+        self.stats["total_flush_ms"] += elapsed_ms
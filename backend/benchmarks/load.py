@@ -0,0 +1,399 @@
+"""Load benchmark for the API, driven in-process through ASGI.
+
+Seeds synthetic companies, orders and history, then runs login, /orders,
+/stats, /orders/report, /orders/search, create_order and update_order at a
+fixed concurrency
+while websocket subscribers listen for the new-order events. Prints one JSON
+document with throughput and p50/p95/p99 latency per scenario, meant to be
+saved per commit and diffed.
+
+By default the data lives in mongomock-motor (pip install mongomock-motor),
+which measures the Python side only; pass --mongo-url to use a local mongod.
+The benchmark database is dropped before every size.
+
+    cd backend && python benchmarks/load.py [--orders 10000 100000 1000000] \\
+        [--mongo-url mongodb://localhost:27017] [--output results.json]
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import httpx
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+STATUSES = ["جاري", "تم", "ملغي"]
+AREAS = ["عمان", "الزرقاء", "إربد", "العقبة", "السلط", "مادبا"]
+NAMES = ["محمد أحمد", "أحمد علي", "سارة خالد", "ليلى حسن", "عمر يوسف", "نور إبراهيم"]
+PASSWORD = "benchmark"
+SEED_DAYS = 30
+BATCH = 5000
+
+main = None  # imported in load_app() once the database settings are known
+
+
+def load_app(args):
+    global main
+    os.environ["MONGO_URL"] = args.mongo_url or "mongodb://localhost:27017"
+    os.environ["DB_NAME"] = args.db_name
+    main = importlib.import_module("main")
+    # One user hammering the API would mostly measure the rate limiter
+    main.admission.enabled = args.admission
+    if args.mongo_url:
+        return
+
+    from mongomock_motor import AsyncMongoMockClient
+    import mongomock.collection
+
+    # pymongo passes sort= to bulk UpdateOne and ReplaceOne, which mongomock
+    # does not accept
+    builder = mongomock.collection.BulkOperationBuilder
+    add_update = builder.add_update
+    add_replace = builder.add_replace
+
+    def add_update_compat(self, *args, sort=None, **kwargs):
+        return add_update(self, *args, **kwargs)
+
+    def add_replace_compat(self, *args, sort=None, **kwargs):
+        return add_replace(self, *args, **kwargs)
+
+    builder.add_update = add_update_compat
+    builder.add_replace = add_replace_compat
+
+    main.client = AsyncMongoMockClient(tz_aware=True, tzinfo=timezone.utc)
+    main.db = main.client[args.db_name]
+    main.history_log.collection = main.db.order_history
+
+
+# ============= Seeding =============
+
+def make_order(i: int, company: dict, now: datetime) -> dict:
+    created_at = now - timedelta(seconds=random.randrange(SEED_DAYS * 86400))
+    order = {
+        "id": str(uuid.uuid4()),
+        "order_number": f"VP-{i:07d}",
+        "customer_name": random.choice(NAMES),
+        "customer_phone": f"079{random.randrange(10 ** 7):07d}",
+        "delivery_area": random.choice(AREAS),
+        "order_price": round(random.uniform(5, 80), 2),
+        "delivery_cost": random.choice([2.0, 3.0, 3.5]),
+        "status": random.choice(STATUSES),
+        "order_date": created_at.strftime("%Y-%m-%d"),
+        "notes": None,
+        "company_id": company["id"],
+        "company_name": company["company_name"],
+        "created_at": created_at,
+        "updated_at": created_at,
+    }
+    order["search_terms"] = main.order_search_terms(order)
+    return order
+
+
+async def seed(orders: int, companies: int, history_per_order: int) -> dict:
+    # Counters and rollups are built here as well, so the startup hooks find
+    # them present and skip their own rebuild
+    db = main.db
+    await main.client.drop_database(db.name)
+    await main.ensure_indexes()
+    main.company_directory.invalidate()
+    main.user_cache.clear()
+
+    password_hash = main.hash_password(PASSWORD)
+    users = [{"id": str(uuid.uuid4()), "username": "bench-admin", "password_hash": password_hash,
+              "role": "admin", "company_name": None, "created_at": datetime.now(timezone.utc)}]
+    for n in range(companies):
+        users.append({"id": str(uuid.uuid4()), "username": f"bench-company-{n}", "password_hash": password_hash,
+                      "role": "company", "company_name": f"Bench Company {n}", "created_at": datetime.now(timezone.utc)})
+    await db.users.insert_many(users)
+    company_users = users[1:]
+
+    now = datetime.now(timezone.utc)
+    counters = {main.ALL_COMPANIES: main.empty_stats()}
+    rollups = {}
+    order_ids = []
+    for start in range(0, orders, BATCH):
+        batch = [make_order(i, company_users[i % companies], now) for i in range(start, min(start + BATCH, orders))]
+        await db.orders.insert_many(batch)
+
+        history = []
+        for order in batch:
+            order_ids.append((order["company_id"], order["id"]))
+            status_key = main.STATUS_COUNTERS[order["status"]]
+            for stats in (counters.setdefault(order["company_id"], main.empty_stats()), counters[main.ALL_COMPANIES]):
+                stats["total"] += 1
+                stats[status_key] += 1
+
+            day = main.order_day(order)
+            rollup = rollups.setdefault((day, order["company_id"], order["delivery_area"]), {
+                "day": day,
+                "company_id": order["company_id"],
+                "delivery_area": order["delivery_area"],
+                "company_name": order["company_name"],
+                **main.empty_rollup(),
+            })
+            amounts = {"orders": 1, "order_price": order["order_price"], "delivery_cost": order["delivery_cost"]}
+            main.add_rollup(rollup, {**amounts, "status": {order["status"]: amounts}})
+
+            for _ in range(history_per_order):
+                entry = main.history_entry(order["id"], "created", {}, company_users[0])
+                entry["timestamp"] = order["created_at"]
+                history.append(entry)
+        if history:
+            await db.order_history.insert_many(history)
+
+    await db.order_counters.insert_many([{"_id": key, **stats} for key, stats in counters.items()])
+    await db.daily_rollups.insert_many(list(rollups.values()))
+    return {"admin": users[0], "companies": company_users, "order_ids": order_ids, "now": now}
+
+
+# ============= Websocket subscribers =============
+
+class WebSocketSubscriber:
+    # Minimal in-process websocket client speaking ASGI to the app directly;
+    # records when each new_order event arrives, keyed by order number.
+    def __init__(self, app, company_id: str):
+        self.app = app
+        self.company_id = company_id
+        self.received: dict[str, float] = {}
+        self.accepted = asyncio.Event()
+        self.closed = asyncio.Event()
+        self._connected = False
+        self._task = None
+
+    async def start(self):
+        scope = {
+            "type": "websocket",
+            "asgi": {"version": "3.0"},
+            "scheme": "ws",
+            "path": f"/orders/{self.company_id}",
+            "raw_path": f"/orders/{self.company_id}".encode(),
+            "root_path": "",
+            "query_string": b"",
+            "headers": [],
+            "client": ("127.0.0.1", 0),
+            "server": ("testserver", 80),
+            "subprotocols": [],
+        }
+        self._task = asyncio.create_task(self.app(scope, self._receive, self._send))
+        await self.accepted.wait()
+
+    async def stop(self):
+        self.closed.set()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _receive(self):
+        if not self._connected:
+            self._connected = True
+            return {"type": "websocket.connect"}
+        await self.closed.wait()
+        return {"type": "websocket.disconnect", "code": 1000}
+
+    async def _send(self, message):
+        if message["type"] == "websocket.accept":
+            self.accepted.set()
+        elif message["type"] == "websocket.send":
+            frame = json.loads(message.get("text") or message["bytes"])
+            received = time.perf_counter()
+            for event in frame["events"] if frame.get("type") == "batch" else [frame]:
+                if event.get("type") == "new_order":
+                    self.received[event["order"]["order_number"]] = received
+        elif message["type"] == "websocket.close":
+            self.closed.set()
+
+
+# ============= Scenarios =============
+
+def percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies: list, errors: int, elapsed: float) -> dict:
+    ordered = sorted(latencies)
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(ordered, 50) * 1000, 3),
+        "p95_ms": round(percentile(ordered, 95) * 1000, 3),
+        "p99_ms": round(percentile(ordered, 99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3) if ordered else 0.0,
+    }
+
+
+async def run_scenario(requests: int, concurrency: int, call) -> dict:
+    # call(i) issues request i and returns the httpx response
+    latencies, errors = [], 0
+    counter = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            started = time.perf_counter()
+            try:
+                response = await call(i)
+                ok = response.status_code < 400
+            except Exception:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+async def login_client(transport, username: str) -> httpx.AsyncClient:
+    client = httpx.AsyncClient(transport=transport, base_url="http://testserver")
+    response = await client.post("/api/auth/login", json={"username": username, "password": PASSWORD})
+    response.raise_for_status()
+    return client
+
+
+async def run_size(args, orders: int) -> dict:
+    seed_started = time.perf_counter()
+    data = await seed(orders, args.companies, args.history_per_order)
+    seed_seconds = time.perf_counter() - seed_started
+
+    transport = httpx.ASGITransport(app=main.app)
+    results = {}
+    async with main.app.router.lifespan_context(main.app):
+        admin = await login_client(transport, data["admin"]["username"])
+        company_user = data["companies"][0]
+        company = await login_client(transport, company_user["username"])
+        anonymous = httpx.AsyncClient(transport=transport, base_url="http://testserver")
+        n = args.requests
+        c = args.concurrency
+
+        results["login"] = await run_scenario(args.login_requests, c, lambda i: anonymous.post(
+            "/api/auth/login", json={"username": company_user["username"], "password": PASSWORD}))
+        results["orders_company_page"] = await run_scenario(n, c, lambda i: company.get(
+            "/api/orders", params={"limit": 50}))
+        results["orders_admin_page"] = await run_scenario(n, c, lambda i: admin.get(
+            "/api/orders", params={"limit": 100}))
+        results["stats_company"] = await run_scenario(n, c, lambda i: company.get("/api/stats"))
+        results["stats_admin"] = await run_scenario(n, c, lambda i: admin.get("/api/stats"))
+        report_day = (data["now"] - timedelta(days=1)).strftime("%Y-%m-%d")
+        results["report"] = await run_scenario(max(1, n // 10), c, lambda i: admin.get(
+            "/api/orders/report", params={"date": report_day}))
+        # Seeded phones are 079 + 7 random digits: 7 digits match about one
+        # order in 10^4, the 4-digit minimum about one in 10 (scan-capped)
+        results["search_phone"] = await run_scenario(n, c, lambda i: admin.get(
+            "/api/orders/search", params={"q": f"079{random.randrange(10 ** 4):04d}"}))
+        results["search_phone_broad"] = await run_scenario(n, c, lambda i: admin.get(
+            "/api/orders/search", params={"q": f"079{random.randrange(10)}"}))
+        results["search_name_company"] = await run_scenario(n, c, lambda i: company.get(
+            "/api/orders/search", params={"q": random.choice(NAMES).split()[0]}))
+
+        subscribers = [WebSocketSubscriber(main.app, company_user["id"]) for _ in range(args.subscribers)]
+        for subscriber in subscribers:
+            await subscriber.start()
+        sent_at = {}
+
+        async def create(i):
+            order_number = f"BENCH-{i:07d}"
+            sent_at[order_number] = time.perf_counter()
+            return await company.post("/api/orders", json={
+                "order_number": order_number,
+                "customer_name": random.choice(NAMES),
+                "customer_phone": f"078{i:07d}",
+                "delivery_area": random.choice(AREAS),
+                "order_price": 20.0,
+                "delivery_cost": 2.0,
+                "status": "جاري",
+                "order_date": data["now"].strftime("%Y-%m-%d"),
+            })
+
+        results["create_order"] = await run_scenario(n, c, create)
+        await asyncio.sleep(0.1)
+        deliveries = [
+            received - sent_at[order_number]
+            for subscriber in subscribers
+            for order_number, received in subscriber.received.items()
+        ]
+        expected = len(sent_at) * len(subscribers)
+        results["websocket_delivery"] = {
+            "subscribers": len(subscribers),
+            **summarize(deliveries, expected - len(deliveries), 0),
+        }
+        del results["websocket_delivery"]["throughput_rps"]
+        for subscriber in subscribers:
+            await subscriber.stop()
+
+        company_orders = [order_id for company_id, order_id in data["order_ids"] if company_id == company_user["id"]]
+        results["update_order"] = await run_scenario(n, c, lambda i: company.put(
+            f"/api/orders/{random.choice(company_orders)}", json={"status": STATUSES[i % 3], "notes": f"bench {i}"}))
+
+        for client in (admin, company, anonymous):
+            await client.aclose()
+
+    return {"orders": orders, "seed_seconds": round(seed_seconds, 2), "scenarios": results}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def run(args) -> dict:
+    random.seed(args.seed)
+    load_app(args)
+    report = {
+        "commit": git_commit(),
+        "backend": "mongod" if args.mongo_url else "mongomock",
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "mongo_url")},
+        "runs": [],
+    }
+    for orders in args.orders:
+        print(f"Seeding {orders} orders...", file=sys.stderr)
+        result = await run_size(args, orders)
+        report["runs"].append(result)
+        for name, stats in result["scenarios"].items():
+            print(f"{orders:>8} {name:<22} p50 {stats['p50_ms']:8.2f} ms | p95 {stats['p95_ms']:8.2f} ms | "
+                  f"p99 {stats['p99_ms']:8.2f} ms | errors {stats['errors']}", file=sys.stderr)
+    await main.client.drop_database(args.db_name)
+    return report
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--orders", type=int, nargs="+", default=[10000])
+    parser.add_argument("--companies", type=int, default=20)
+    parser.add_argument("--history-per-order", type=int, default=1)
+    parser.add_argument("--requests", type=int, default=500, help="requests per scenario")
+    parser.add_argument("--login-requests", type=int, default=50, help="login is bcrypt-bound, so fewer")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--subscribers", type=int, default=50, help="websocket subscribers on one company")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--mongo-url", help="local mongod to use instead of mongomock-motor")
+    parser.add_argument("--db-name", default="vperfumes_benchmark")
+    parser.add_argument("--admission", action="store_true", help="keep admission control and rate limits on")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,106 @@
+"""Micro-benchmark for the /api/orders response path.
+
+Compares serializing N order documents the way FastAPI does with
+response_model=List[Order] (validate, jsonable_encoder, json) against the
+fast path in main.py (order_out + orjson).
+
+    cd backend && python benchmarks/serialization.py [--sizes 1000 10000 100000]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+# main.py refuses to import without these; no connection is made
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "benchmark")
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from pydantic import TypeAdapter  # noqa: E402
+
+import main  # noqa: E402
+
+STATUSES = ["جاري", "تم", "ملغي"]
+
+
+def make_orders(count: int) -> list[dict]:
+    now = datetime(2025, 11, 19, 12, 0, 0)
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "order_number": f"VP-{i:07d}",
+            "customer_name": "محمد أحمد",
+            "customer_phone": f"079{i:07d}",
+            "delivery_area": "عمان",
+            "order_price": 25.5,
+            "delivery_cost": 2.0,
+            "status": STATUSES[i % 3],
+            "order_date": "2025-11-19",
+            "notes": None,
+            "company_id": "company-1",
+            "company_name": "VPerfumes",
+            "created_at": now - timedelta(seconds=i),
+            "updated_at": now - timedelta(seconds=i),
+        }
+        for i in range(count)
+    ]
+
+
+def response_model_path(orders: list[dict]) -> bytes:
+    validated = TypeAdapter(List[main.Order]).validate_python(orders)
+    return json.dumps(jsonable_encoder(validated), ensure_ascii=False).encode()
+
+
+def pydantic_dump_path(orders: list[dict]) -> bytes:
+    adapter = TypeAdapter(List[main.Order])
+    return adapter.dump_json(adapter.validate_python(orders))
+
+
+def fast_path(orders: list[dict]) -> bytes:
+    return main.FastJSONResponse([main.order_out(order) for order in orders]).body
+
+
+def best_of(fn, orders, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn(orders)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        orders = make_orders(size)
+        assert json.loads(fast_path(orders)) == json.loads(response_model_path(orders))
+        row = {
+            "orders": size,
+            "response_model_ms": best_of(response_model_path, orders, args.repeat) * 1000,
+            "pydantic_dump_json_ms": best_of(pydantic_dump_path, orders, args.repeat) * 1000,
+            "fast_path_ms": best_of(fast_path, orders, args.repeat) * 1000,
+        }
+        row["speedup"] = row["response_model_ms"] / row["fast_path_ms"]
+        results.append(row)
+        print(
+            f"{size:>7} orders: response_model {row['response_model_ms']:9.1f} ms | "
+            f"pydantic dump_json {row['pydantic_dump_json_ms']:9.1f} ms | "
+            f"fast path {row['fast_path_ms']:8.1f} ms | x{row['speedup']:.1f}",
+            file=sys.stderr
+        )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,24 +1,58 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Query, WebSocket, Request
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from cachetools import LRUCache, TTLCache
+from realtime import BroadcastHub, InProcessBroker, MongoChangeStreamBroker, InProcessSequencer, MongoSequencer
+from audit import WriteBehindLog
+from metrics import registry, MetricsMiddleware, MongoCommandMetrics
+from admission import AdmissionControl, AdmissionMiddleware, parse_limits
+from pymongo import ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import os
+import asyncio
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict
+from pydantic import BaseModel, Field, ConfigDict, ValidationError
 from typing import List, Optional
 import uuid
+import time as time_module
 from datetime import datetime, timezone, timedelta, time
+import base64
+import json
+import csv
+import io
+import re
 from passlib.context import CryptContext
 import jwt
 from fastapi import Response
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
+import orjson
 from fastapi import Cookie
 from fastapi.encoders import jsonable_encoder
+from contextlib import asynccontextmanager
+
+try:
+    from brotli_asgi import BrotliMiddleware
+except ImportError:
+    BrotliMiddleware = None
 
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# LOG_LEVEL=DEBUG turns on per-request and websocket logs; they are skipped
+# before formatting at the default level
+logging.basicConfig(
+    level=os.environ.get("LOG_LEVEL", "INFO").upper(),
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
 
 # mongodb+srv://ahmad812002_db_user:<db_password>@dana.51p0ug4.mongodb.net/
 
@@ -30,9 +64,7 @@ import os
 mongo_url = os.environ.get("MONGO_URL")
 db_name = os.environ.get("DB_NAME")
 
-print("ENV CHECK")
-print("MONGO_URL:", repr(os.environ.get("MONGO_URL")))
-print("DB_NAME:", repr(os.environ.get("DB_NAME")))
+logger.debug("env MONGO_URL set=%s DB_NAME=%r", bool(mongo_url), db_name)
 
 if not mongo_url:
     raise RuntimeError("MONGO_URL is not set")
@@ -40,7 +72,21 @@ if not db_name:
     raise RuntimeError("DB_NAME is not set")
 
 
-client = AsyncIOMotorClient(mongo_url)
+# Pool settings; Motor connects lazily, the lifespan handler warms the pool
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", "10"))
+MONGO_STARTUP_RETRIES = int(os.environ.get("MONGO_STARTUP_RETRIES", "5"))
+client = AsyncIOMotorClient(
+    mongo_url,
+    maxPoolSize=int(os.environ.get("MONGO_MAX_POOL_SIZE", "100")),
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    maxIdleTimeMS=int(os.environ.get("MONGO_MAX_IDLE_MS", "300000")),
+    connectTimeoutMS=int(os.environ.get("MONGO_CONNECT_TIMEOUT_MS", "5000")),
+    serverSelectionTimeoutMS=int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000")),
+    event_listeners=[MongoCommandMetrics()],
+    # Dates come back as aware UTC, so responses carry the offset
+    tz_aware=True,
+    tzinfo=timezone.utc,
+)
 db = client[db_name]
 
 
@@ -51,8 +97,35 @@ SECRET_KEY = os.environ.get("JWT_SECRET", "vperfumes-secret-key-2025")
 ALGORITHM = "HS256"
 # security = HTTPBearer()
 
+# JSON responses are rendered with orjson
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Startup and shutdown steps are defined at the end of this file
+    await connect_mongo()
+    await create_indexes()
+    await build_order_counters()
+    await build_search_terms()
+    await start_hub()
+    await build_daily_rollups()
+    await start_history_log()
+    app.state.ready = True
+    install_drain_handlers()
+    yield
+    # Under uvicorn the signal handler has already drained; these steps
+    # cover the other ways out (test clients, --reload)
+    app.state.ready = False
+    await stop_hub()
+    await drain_history_log()
+    await shutdown_db_client()
+
 # FastAPI App
-app = FastAPI()
+app = FastAPI(default_response_class=FastJSONResponse, lifespan=lifespan)
+app.state.ready = False
+app.add_middleware(MetricsMiddleware)
 api_router = APIRouter(prefix="/api")
 
 
@@ -60,30 +133,63 @@ api_router = APIRouter(prefix="/api")
 ws_router = APIRouter()
 
 
-company_clients: dict[str, list[WebSocket]] = {}
+# Broadcast hub for order events. WS_BROKER=mongo fans events out to every
+# worker through a change stream on ws_events and numbers them in
+# ws_sequences; the default stays in-process.
+if os.environ.get("WS_BROKER", "local").lower() == "mongo":
+    ws_broker = MongoChangeStreamBroker(db.ws_events)
+    ws_sequencer = MongoSequencer(db.ws_sequences)
+else:
+    ws_broker = InProcessBroker()
+    ws_sequencer = InProcessSequencer()
+hub = BroadcastHub(
+    ws_broker,
+    ws_sequencer,
+    queue_size=int(os.environ.get("WS_QUEUE_SIZE", "100")),
+    send_timeout=float(os.environ.get("WS_SEND_TIMEOUT", "5")),
+    replay_size=int(os.environ.get("WS_REPLAY_SIZE", "256")),
+    batch_window=int(os.environ.get("WS_BATCH_MS", "10")) / 1000,
+)
+
+ws_connections_opened = registry.counter("websocket_connections_opened_total", "Websocket connections accepted")
+registry.callback_gauge("websocket_connections", "Open websocket connections", hub.connection_count)
+registry.callback_gauge("websocket_messages_sent", "Websocket messages delivered", lambda: hub.stats["sent"])
+registry.callback_gauge("websocket_send_failures", "Websocket sends that failed or timed out", lambda: hub.stats["send_failures"])
+registry.callback_gauge("websocket_dropped_slow", "Subscribers dropped for a full queue", lambda: hub.stats["dropped_slow"])
+registry.callback_gauge("websocket_replayed_events", "Events replayed to reconnecting clients", lambda: hub.stats["replayed"])
+registry.callback_gauge("websocket_resyncs", "Reconnects told to resync", lambda: hub.stats["resyncs"])
+
 @ws_router.websocket("/orders/{company_id}")
-async def ws_orders(websocket: WebSocket, company_id: str):
-    
-    print("WS attempt for:", company_id)
+async def ws_orders(
+        websocket: WebSocket,
+        company_id: str,
+        last_seq: Optional[int] = None,
+        epoch: Optional[str] = None
+):
+    # Reconnecting clients pass the seq and epoch of the last event they
+    # applied and get the missed events replayed, or a "resync" frame
+    if hub.draining:
+        # Shutting down: reject the handshake so the client tries another worker
+        await websocket.close(code=1012)
+        return
+
     await websocket.accept()
-    print("WS accepted:", company_id)
+    ws_connections_opened.inc()
+    logger.debug("ws connected company_id=%s", company_id)
 
-    if company_id not in company_clients:
-        company_clients[company_id] = []
-    company_clients[company_id].append(websocket)
+    subscriber = await hub.connect(company_id, websocket, last_seq=last_seq, epoch=epoch)
     try:
         while True:
-            await websocket.receive()
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
 
     except Exception:
         pass
 
     finally:
-        if company_id in company_clients and websocket in company_clients[company_id]:
-            print("WS CLOSED:", company_id)
-            company_clients.get(company_id, []).remove(websocket)
-        if company_id in company_clients and not company_clients[company_id]:
-            del company_clients[company_id]
+        logger.debug("ws closed company_id=%s", company_id)
+        await hub.disconnect(subscriber)
         
         
 app.include_router(ws_router)
@@ -92,13 +198,27 @@ app.include_router(ws_router)
 async def get_data():
     return {"message": "Hello from the backend!"}
 
+# Liveness: the process is serving requests
+@app.get("/healthz", include_in_schema=False)
+async def healthz():
+    return {"status": "ok"}
 
-print("Connecting to Mongo...")
-try:
-    client.admin.command("ping")
-    print("MongoDB Connected!")
-except Exception as e:
-    print("MongoDB Error:", e)
+# Readiness: startup finished, not draining, and Mongo answers
+@app.get("/readyz", include_in_schema=False)
+async def readyz():
+    if not app.state.ready or hub.draining:
+        return JSONResponse({"status": "not ready"}, status_code=503)
+    try:
+        await asyncio.wait_for(client.admin.command("ping"), READY_PING_TIMEOUT)
+    except Exception as e:
+        logger.warning("Readiness ping failed: %s", e)
+        return JSONResponse({"status": "mongo unavailable"}, status_code=503)
+    return {"status": "ready"}
+
+# Prometheus scrape endpoint
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
 
 
 
@@ -172,11 +292,16 @@ class OrderHistory(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     order_id: str
     action: str  # "created" or "updated"
-    changes: dict
+    changes: Optional[dict] = None  # None when left out of a history listing
     user_id: str
     username: str
     timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class HistoryBatchRequest(BaseModel):
+    order_ids: List[str] = Field(..., max_length=500)
+    limit: int = Field(5, ge=1, le=100)
+    include_changes: bool = False
+
 class Company(BaseModel): 
     company_name: str
     username: str
@@ -184,12 +309,109 @@ class Company(BaseModel):
 
 # ============= Helper Functions =============
 
+# FAST_JSON=0 sends list endpoints back through response_model validation
+FAST_JSON = os.environ.get("FAST_JSON", "1").lower() not in ("0", "false", "no")
+ORDER_DEFAULTS = {
+    name: None if field.is_required() or field.default_factory else field.default
+    for name, field in Order.model_fields.items()
+}
+
+def order_out(doc: dict) -> dict:
+    # The Order response shape for a document we wrote ourselves,
+    # without a pydantic round trip
+    out = {name: doc.get(name, default) for name, default in ORDER_DEFAULTS.items()}
+    for key in ("order_price", "delivery_cost"):
+        if isinstance(out[key], int):
+            out[key] = float(out[key])
+    return out
+
+def orders_response(orders: list[dict], response: Optional[Response] = None):
+    if not FAST_JSON:
+        return orders
+    headers = dict(response.headers) if response is not None else None
+    return FastJSONResponse([order_out(order) for order in orders], headers=headers)
+
 def hash_password(password: str) -> str:
     return pwd_context.hash(password)
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
+# bcrypt takes hundreds of ms per call, so it runs in a dedicated pool
+# instead of blocking the event loop. PASSWORD_EXECUTOR=process switches
+# from threads to processes; PASSWORD_WORKERS bounds the pool size.
+PASSWORD_WORKERS = int(os.environ.get("PASSWORD_WORKERS", str(min(4, os.cpu_count() or 1))))
+if os.environ.get("PASSWORD_EXECUTOR", "thread").lower() == "process":
+    password_executor = ProcessPoolExecutor(max_workers=PASSWORD_WORKERS)
+else:
+    password_executor = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix="bcrypt")
+password_pool_stats = {"pending": 0, "max_pending": 0, "completed": 0}
+
+async def run_password_task(fn, *args):
+    # pending counts tasks running or waiting for a free worker
+    password_pool_stats["pending"] += 1
+    password_pool_stats["max_pending"] = max(password_pool_stats["max_pending"], password_pool_stats["pending"])
+    try:
+        return await asyncio.get_running_loop().run_in_executor(password_executor, fn, *args)
+    finally:
+        password_pool_stats["pending"] -= 1
+        password_pool_stats["completed"] += 1
+
+def encode_cursor(sort_value: datetime | str, item_id: str) -> str:
+    # Opaque keyset cursor: (sort value, id) of the last item on the page.
+    # History timestamps stay ISO strings until "python manage.py
+    # migrate-datetimes" has run, so both types round-trip.
+    if isinstance(sort_value, datetime):
+        data = {"c": sort_value.isoformat(), "i": item_id}
+    else:
+        data = {"s": sort_value, "i": item_id}
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> tuple[datetime | str, str]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        sort_value = datetime.fromisoformat(data["c"]) if "c" in data else str(data["s"])
+        return sort_value, str(data["i"])
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+# Changes written within this window before a sync token was issued are sent
+# again on the next sync, so writes still in flight are never missed
+SYNC_OVERLAP = timedelta(seconds=2)
+# Deleted or archived ids one sync returns; past this (e.g. after an
+# archive run) the client is told to reload /orders instead
+SYNC_TOMBSTONE_LIMIT = 10000
+
+def encode_sync_token(since: datetime, after_id: Optional[str] = None) -> str:
+    data = {"t": since.astimezone(timezone.utc).isoformat()}
+    if after_id:
+        data["i"] = after_id
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip("=")
+
+def decode_sync_token(token: str) -> tuple[datetime, Optional[str]]:
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        since = datetime.fromisoformat(data["t"])
+        since = since if since.tzinfo else since.replace(tzinfo=timezone.utc)
+        return since, data.get("i")
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise HTTPException(status_code=400, detail="Invalid sync token")
+
+def current_sync_token() -> str:
+    return encode_sync_token(datetime.now(timezone.utc) - SYNC_OVERLAP)
+
+def day_bounds(date: str) -> tuple[datetime, datetime]:
+    # "2025-11-19" -> 2025-11-19 00:00:00 .. 2025-11-19 23:59:59.999999 UTC
+    try:
+        day = datetime.strptime(date, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
+    start = datetime.combine(day, time.min).replace(tzinfo=timezone.utc)
+    end = datetime.combine(day, time.max).replace(tzinfo=timezone.utc)
+    return start, end
+
 def create_access_token(data: dict) -> str:
     to_encode = data.copy()
     expire = datetime.now(timezone.utc) + timedelta(days=7)
@@ -216,9 +438,83 @@ def create_access_token(data: dict) -> str:
 #         raise HTTPException(status_code=401, detail="Invalid token")
 
 
+# Authenticated user records keyed by user id, so most requests skip the
+# users lookup. USER_CACHE=0 disables it; entries are dropped explicitly
+# when a password changes or an account is deleted.
+USER_CACHE_ENABLED = os.environ.get("USER_CACHE", "1").lower() not in ("0", "false", "no")
+user_cache = TTLCache(
+    maxsize=int(os.environ.get("USER_CACHE_SIZE", "1024")),
+    ttl=float(os.environ.get("USER_CACHE_TTL", "60")),
+)
+user_cache_stats = {"hits": 0, "misses": 0}
+
+async def load_user(user_id: str) -> Optional[dict]:
+    if USER_CACHE_ENABLED:
+        user = user_cache.get(user_id)
+        if user is not None:
+            user_cache_stats["hits"] += 1
+            return dict(user)
+        user_cache_stats["misses"] += 1
+
+    user = await db.users.find_one({"id": user_id}, {"_id": 0})
+    if user and USER_CACHE_ENABLED:
+        user_cache[user_id] = dict(user)
+    return user
+
+def invalidate_user(user_id: str):
+    user_cache.pop(user_id, None)
+
+class CompanyDirectory:
+    # All company accounts (without password hashes) indexed by id, name and
+    # username. Loaded on first use and dropped by register/delete_company;
+    # the TTL bounds how stale another worker's copy can get. Callers that
+    # hold the current companies data version pass it in, and a copy loaded
+    # under another version is reloaded.
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._loaded_at = None
+        self.version = None
+        self._lock = asyncio.Lock()
+        self.by_id: dict[str, dict] = {}
+        self.by_name: dict[str, dict] = {}
+        self.by_username: dict[str, dict] = {}
+
+    def invalidate(self):
+        self._loaded_at = None
+
+    def _fresh(self, version=None) -> bool:
+        if self._loaded_at is None or time_module.monotonic() - self._loaded_at >= self.ttl:
+            return False
+        return version is None or version == self.version
+
+    async def load(self, force: bool = False, version=None):
+        if not force and self._fresh(version):
+            return
+        async with self._lock:
+            if not force and self._fresh(version):
+                return
+            companies = await db.users.find({"role": "company"}, {"_id": 0, "password_hash": 0}).to_list(None)
+            self.by_id = {c["id"]: c for c in companies}
+            self.by_name = {c["company_name"]: c for c in companies if c.get("company_name")}
+            self.by_username = {c["username"]: c for c in companies}
+            self._loaded_at = time_module.monotonic()
+            # Read before the load: a change landing during it only costs a reload
+            self.version = version
+
+    async def find_by_name(self, company_name: Optional[str]) -> Optional[dict]:
+        await self.load()
+        if company_name not in self.by_name:
+            # Possibly registered through another worker since our load
+            await self.load(force=True)
+        return self.by_name.get(company_name)
+
+    async def all(self, version=None) -> list[dict]:
+        await self.load(version=version)
+        return [dict(company) for company in self.by_id.values()]
+
+company_directory = CompanyDirectory(ttl=float(os.environ.get("COMPANY_DIRECTORY_TTL", "300")))
+
 async def get_current_user(access_token: str | None = Cookie(default=None, alias="access_token")):
-    print("Cookie Received:", access_token)
-    
     if not access_token:
         raise HTTPException(status_code=401, detail="Not authenticated")
     try:
@@ -227,7 +523,7 @@ async def get_current_user(access_token: str | None = Cookie(default=None, alias
         if not user_id :
             raise HTTPException(status_code=401, detail="Invalid token")
         
-        current_user = await db.users.find_one({"id": user_id}, {"_id": 0})
+        current_user = await load_user(user_id)
 
         if not current_user :
             raise HTTPException(status_code=401, detail="User not found")
@@ -239,6 +535,752 @@ async def get_current_user(access_token: str | None = Cookie(default=None, alias
         raise HTTPException(status_code=401, detail="Invalid token")
     
 
+# ============= Stats Counters =============
+
+# Materialized per-company order counters (opt-in), so /stats is a single read.
+# Run "python manage.py reconcile-stats" after enabling or if they drift.
+USE_STATS_COUNTERS = os.environ.get("USE_STATS_COUNTERS", "").lower() in ("1", "true", "yes")
+ALL_COMPANIES = "__all__"
+STATUS_COUNTERS = {"جاري": "ongoing", "تم": "completed", "ملغي": "cancelled"}
+
+def empty_stats() -> dict:
+    return {"total": 0, "ongoing": 0, "completed": 0, "cancelled": 0}
+
+def status_deltas(old_status: Optional[str], new_status: Optional[str]) -> dict:
+    # Counter increments for an order moving from old_status to new_status
+    # (None means the order does not exist on that side of the change)
+    deltas = {}
+    if old_status is None:
+        deltas["total"] = 1
+    if new_status is None:
+        deltas["total"] = -1
+    if old_status in STATUS_COUNTERS:
+        deltas[STATUS_COUNTERS[old_status]] = -1
+    if new_status in STATUS_COUNTERS:
+        key = STATUS_COUNTERS[new_status]
+        deltas[key] = deltas.get(key, 0) + 1
+    return {k: v for k, v in deltas.items() if v}
+
+async def bump_order_counters(company_id: str, old_status: Optional[str], new_status: Optional[str]):
+    await bump_order_counters_many([(company_id, old_status, new_status)])
+
+async def bump_order_counters_many(transitions: list[tuple[str, Optional[str], Optional[str]]]):
+    # (company_id, old_status, new_status) per order, written in one round trip
+    if not USE_STATS_COUNTERS:
+        return
+    per_company: dict[str, dict] = {}
+    for company_id, old_status, new_status in transitions:
+        for counters_id in (company_id, ALL_COMPANIES):
+            totals = per_company.setdefault(counters_id, {})
+            for key, value in status_deltas(old_status, new_status).items():
+                totals[key] = totals.get(key, 0) + value
+
+    updates = [
+        UpdateOne({"_id": counters_id}, {"$inc": deltas}, upsert=True)
+        for counters_id, deltas in per_company.items()
+        if any(deltas.values())
+    ]
+    if updates:
+        await db.order_counters.bulk_write(updates, ordered=False)
+
+def stats_pipeline(query: dict) -> list:
+    return [
+        {"$match": query},
+        {"$group": {"_id": "$status", "count": {"$sum": 1}}},
+    ]
+
+async def aggregate_stats(query: dict) -> dict:
+    # One $group pass over the hot tier instead of a count_documents call
+    # per status. Archived orders still count, like in the counters, but
+    # come from archive_counters rather than a scan of the cold tier.
+    stats = empty_stats()
+    async for row in db.orders.aggregate(stats_pipeline(query)):
+        stats["total"] += row["count"]
+        if row["_id"] in STATUS_COUNTERS:
+            stats[STATUS_COUNTERS[row["_id"]]] += row["count"]
+
+    archived = await db.archive_counters.find_one({"_id": query.get("company_id", ALL_COMPANIES)}, {"_id": 0})
+    for key, count in (archived or {}).items():
+        stats[key] += count
+    return stats
+
+async def count_orders(collections) -> dict[str, dict]:
+    # Stats per company_id, plus ALL_COMPANIES, over the given tiers
+    per_company: dict[str, dict] = {}
+    overall = empty_stats()
+    for collection in collections:
+        async for row in db[collection].aggregate([
+            {"$group": {"_id": {"company_id": "$company_id", "status": "$status"}, "count": {"$sum": 1}}},
+        ]):
+            company_id = row["_id"].get("company_id")
+            status_key = STATUS_COUNTERS.get(row["_id"].get("status"))
+            for stats in (per_company.setdefault(company_id, empty_stats()), overall):
+                stats["total"] += row["count"]
+                if status_key:
+                    stats[status_key] += row["count"]
+    per_company[ALL_COMPANIES] = overall
+    return per_company
+
+async def write_counters(collection: str, per_company: dict[str, dict]):
+    for company_id, stats in per_company.items():
+        await db[collection].replace_one({"_id": company_id}, stats, upsert=True)
+    await db[collection].delete_many({"_id": {"$nin": list(per_company)}})
+
+async def reconcile_order_counters() -> int:
+    # Rebuild every counters document from both order tiers
+    per_company = await count_orders(ORDER_TIERS)
+    await write_counters("order_counters", per_company)
+    return len(per_company) - 1
+
+async def refresh_archive_counters():
+    # Archived orders cannot change, so these only move when an archive
+    # run adds some
+    await write_counters("archive_counters", await count_orders(["orders_archive"]))
+
+# ============= Data Versions =============
+
+# data_versions holds a counter per company, one for all orders
+# (ALL_COMPANIES) and one for the company list. Mutations bump the affected
+# counters after writing; the read routes derive their ETag from them, so a
+# matching If-None-Match is answered without reading the data itself.
+COMPANIES_VERSION = "__companies__"
+ETAG_CACHE_CONTROL = "private, no-cache"
+
+async def bump_versions(*keys: str):
+    # epoch is new whenever a counter is recreated, so tags from before a
+    # reset cannot match
+    await db.data_versions.bulk_write([
+        UpdateOne({"_id": key}, {"$inc": {"version": 1}, "$setOnInsert": {"epoch": uuid.uuid4().hex[:8]}}, upsert=True)
+        for key in set(keys)
+    ], ordered=False)
+
+async def bump_order_versions(*company_ids: str):
+    await bump_versions(ALL_COMPANIES, *(str(company_id) for company_id in company_ids))
+
+async def data_version(key: str) -> Optional[tuple[str, int]]:
+    # (epoch, version), None until the first mutation creates the counter
+    doc = await db.data_versions.find_one({"_id": key})
+    if doc is None:
+        return None
+    return doc["epoch"], doc["version"]
+
+def format_etag(key: str, version: Optional[tuple[str, int]]) -> Optional[str]:
+    # No counter: no ETag, no 304
+    if version is None:
+        return None
+    epoch, number = version
+    return f'W/"{key}-{epoch}-{number}"'
+
+async def version_etag(key: str) -> Optional[str]:
+    return format_etag(key, await data_version(key))
+
+def etag_matches(request: Request, etag: Optional[str]) -> bool:
+    header = request.headers.get("if-none-match")
+    if not etag or not header:
+        return False
+    # Weak comparison, as If-None-Match requires
+    tags = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+def set_etag(response: Response, etag: Optional[str]):
+    if etag:
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = ETAG_CACHE_CONTROL
+
+def not_modified(etag: str, response: Optional[Response] = None) -> Response:
+    headers = dict(response.headers) if response is not None else {}
+    headers.pop("content-length", None)
+    headers.update({"ETag": etag, "Cache-Control": ETAG_CACHE_CONTROL})
+    return Response(status_code=304, headers=headers)
+
+def version_key(current_user: dict) -> str:
+    # Company users see their own orders, admins all of them
+    return current_user["id"] if current_user["role"] == "company" else ALL_COMPANIES
+
+# ============= Locks =============
+
+# Maintenance jobs that must not overlap (across workers or cron runs) hold a
+# lease in the locks collection. An expired lease, left by a crashed holder,
+# is taken over; long jobs renew theirs as they go.
+async def acquire_lock(name: str, ttl: float) -> Optional[str]:
+    # The lease token, or None while someone else holds the lock
+    token = uuid.uuid4().hex
+    now = datetime.now(timezone.utc)
+    try:
+        await db.locks.update_one(
+            {"_id": name, "expires_at": {"$lt": now}},
+            {"$set": {"token": token, "expires_at": now + timedelta(seconds=ttl)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return None
+    return token
+
+async def renew_lock(name: str, token: str, ttl: float):
+    await db.locks.update_one(
+        {"_id": name, "token": token},
+        {"$set": {"expires_at": datetime.now(timezone.utc) + timedelta(seconds=ttl)}}
+    )
+
+async def release_lock(name: str, token: str):
+    await db.locks.delete_one({"_id": name, "token": token})
+
+# ============= Daily Rollups =============
+
+# daily_rollups holds one document per (day, company_id, delivery_area) with
+# order count, order_price and delivery_cost totals, overall and per status.
+# The order write paths keep it current; "python manage.py rebuild-rollups"
+# backfills it.
+ROLLUP_SUMS = ("orders", "order_price", "delivery_cost")
+ROLLUP_LOCK_TTL = 1800
+
+def order_day(order: dict) -> str:
+    created_at = order["created_at"]
+    if isinstance(created_at, str):
+        return created_at[:10]
+    return created_at.strftime("%Y-%m-%d")
+
+def rollup_state(order: dict) -> tuple:
+    # Everything an order contributes to the rollups; legacy documents
+    # missing a field contribute what rollup_update counts for it
+    return (
+        order_day(order),
+        order.get("company_id"),
+        order.get("delivery_area"),
+        order.get("status"),
+        order.get("order_price") or 0,
+        order.get("delivery_cost") or 0,
+    )
+
+def rollup_update(order: dict, sign: int) -> UpdateOne:
+    amounts = {
+        "orders": sign,
+        "order_price": sign * (order.get("order_price") or 0),
+        "delivery_cost": sign * (order.get("delivery_cost") or 0),
+    }
+    inc = dict(amounts)
+    for key, value in amounts.items():
+        inc[f"status.{order.get('status')}.{key}"] = value
+    return UpdateOne(
+        {"day": order_day(order), "company_id": order.get("company_id"), "delivery_area": order.get("delivery_area")},
+        {"$inc": inc, "$set": {"company_name": order.get("company_name")}},
+        upsert=True
+    )
+
+async def apply_rollups(old_order: Optional[dict], new_order: Optional[dict]):
+    # Move an order's contribution from its old state to its new one
+    # (None on the side where the order does not exist)
+    updates = []
+    if old_order is not None:
+        updates.append(rollup_update(old_order, -1))
+    if new_order is not None:
+        updates.append(rollup_update(new_order, 1))
+    if updates:
+        await db.daily_rollups.bulk_write(updates, ordered=False)
+
+def empty_rollup() -> dict:
+    return {key: 0 for key in ROLLUP_SUMS}
+
+def add_rollup(target: dict, source: dict):
+    for key in ROLLUP_SUMS:
+        target[key] += source.get(key, 0)
+    for status_name, amounts in source.get("status", {}).items():
+        status_totals = target.setdefault("status", {}).setdefault(status_name, empty_rollup())
+        for key in ROLLUP_SUMS:
+            status_totals[key] += amounts.get(key, 0)
+
+async def rebuild_daily_rollups(only_if_empty: bool = False) -> Optional[int]:
+    # Documents written, or None when another rebuild holds the lock (or,
+    # with only_if_empty, rollups already exist). Rebuilds share one scratch
+    # collection, so they must not overlap.
+    token = await acquire_lock("rebuild-rollups", ROLLUP_LOCK_TTL)
+    if token is None:
+        return None
+    try:
+        if only_if_empty and await db.daily_rollups.find_one({}):
+            return None
+        return await swap_in_rollups()
+    finally:
+        await release_lock("rebuild-rollups", token)
+
+async def swap_in_rollups() -> int:
+    # Aggregate into a scratch collection, then swap it in atomically
+    rollups: dict[tuple, dict] = {}
+    for collection in ORDER_TIERS:
+        async for row in db[collection].aggregate([
+            {"$project": {
+                "company_id": 1,
+                "company_name": 1,
+                "delivery_area": 1,
+                "status": 1,
+                "order_price": {"$ifNull": ["$order_price", 0]},
+                "delivery_cost": {"$ifNull": ["$delivery_cost", 0]},
+                "day": {"$cond": [
+                    {"$eq": [{"$type": "$created_at"}, "string"]},
+                    {"$substrBytes": ["$created_at", 0, 10]},
+                    {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
+                ]},
+            }},
+            {"$group": {
+                "_id": {"day": "$day", "company_id": "$company_id", "delivery_area": "$delivery_area", "status": "$status"},
+                "company_name": {"$last": "$company_name"},
+                "orders": {"$sum": 1},
+                "order_price": {"$sum": "$order_price"},
+                "delivery_cost": {"$sum": "$delivery_cost"},
+            }},
+        ], allowDiskUse=True):
+            key = row["_id"]
+            amounts = {k: row[k] for k in ROLLUP_SUMS}
+            rollup = rollups.setdefault((key["day"], key.get("company_id"), key.get("delivery_area")), {
+                "day": key["day"],
+                "company_id": key.get("company_id"),
+                "delivery_area": key.get("delivery_area"),
+                "company_name": row["company_name"],
+                **empty_rollup(),
+            })
+            add_rollup(rollup, {**amounts, "status": {str(key.get("status")): amounts}})
+
+    scratch = db.daily_rollups_rebuild
+    await scratch.drop()
+    await scratch.create_index([("day", 1), ("company_id", 1), ("delivery_area", 1)], unique=True)
+    docs = list(rollups.values())
+    for i in range(0, len(docs), 1000):
+        await scratch.insert_many(docs[i:i + 1000])
+    if docs:
+        await scratch.rename("daily_rollups", dropTarget=True)
+    else:
+        await db.daily_rollups.delete_many({})
+    return len(docs)
+
+# ============= Order History Writes =============
+
+# HISTORY_WRITE_BEHIND=1 queues history entries and inserts them in batches
+# from a background task instead of awaiting an insert per request. Keep
+# HISTORY_FLUSH_MS below SYNC_OVERLAP so delta sync still sees tombstones.
+HISTORY_WRITE_BEHIND = os.environ.get("HISTORY_WRITE_BEHIND", "").lower() in ("1", "true", "yes")
+history_log = WriteBehindLog(
+    db.order_history,
+    max_queue=int(os.environ.get("HISTORY_QUEUE_SIZE", "10000")),
+    batch_size=int(os.environ.get("HISTORY_BATCH_SIZE", "500")),
+    flush_interval=int(os.environ.get("HISTORY_FLUSH_MS", "200")) / 1000,
+)
+
+def history_entry(order_id: str, action: str, changes: dict, current_user: dict) -> dict:
+    history = OrderHistory(
+        order_id=order_id,
+        action=action,
+        changes=changes,
+        user_id=current_user["id"],
+        username=current_user["username"]
+    )
+    return history.model_dump()
+
+async def record_history(*history_docs: dict):
+    if HISTORY_WRITE_BEHIND:
+        for history_doc in history_docs:
+            await history_log.put(history_doc)
+    elif len(history_docs) == 1:
+        await db.order_history.insert_one(history_docs[0])
+    elif history_docs:
+        await db.order_history.insert_many(list(history_docs), ordered=False)
+
+# ============= Search =============
+
+# Orders carry a precomputed "search_terms" array: normalized words of
+# customer_name and delivery_area, the lowercased order_number and the
+# digits of customer_phone. /orders/search prefix-matches it through the
+# (company_id, search_terms) multikey index.
+SEARCH_FIELDS = ("order_number", "customer_name", "customer_phone", "delivery_area")
+# Nearly every phone starts with 07: shorter digit tokens (e.g. order
+# number 57) match whole terms instead of prefixes
+SEARCH_MIN_DIGITS = int(os.environ.get("SEARCH_MIN_DIGITS", "4"))
+# Matches read per tier; the index is in term order, not created_at order
+SEARCH_SCAN_LIMIT = int(os.environ.get("SEARCH_SCAN_LIMIT", "1000"))
+ARABIC_DIACRITICS = re.compile("[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]")
+ARABIC_LETTERS = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    "ى": "ي", "ئ": "ي", "ؤ": "و", "ة": "ه",
+    **{chr(0x0660 + i): str(i) for i in range(10)},  # Arabic-Indic digits
+    **{chr(0x06f0 + i): str(i) for i in range(10)},  # Persian digits
+})
+
+def normalize_text(text: str) -> str:
+    # Strip diacritics and tatweel, fold alef/yaa/taa marbuta variants
+    text = ARABIC_DIACRITICS.sub("", text or "")
+    return " ".join(text.translate(ARABIC_LETTERS).lower().split())
+
+PHONE_LIKE = re.compile(r"[\d\s\-+()]+")
+
+def phone_digits(phone: str) -> str:
+    return re.sub(r"\D", "", normalize_text(phone))
+
+def phone_terms(phone: str) -> set[str]:
+    # International numbers are also indexed in their local 07... form
+    digits = phone_digits(phone)
+    terms = {digits}
+    for prefix in ("00962", "962"):
+        if digits.startswith(prefix):
+            terms.add("0" + digits[len(prefix):])
+            break
+    return terms
+
+def order_search_terms(order: dict) -> list[str]:
+    terms = set()
+    for field in ("customer_name", "delivery_area"):
+        terms.update(normalize_text(order.get(field)).split())
+    terms.add(normalize_text(order.get("order_number")).replace(" ", ""))
+    terms.update(phone_terms(order.get("customer_phone")))
+    terms.discard("")
+    return sorted(terms)
+
+def search_query(q: str) -> Optional[dict]:
+    # Every word of the query must prefix-match one of the order's terms;
+    # short numbers must match a term exactly
+    normalized = normalize_text(q)
+    if PHONE_LIKE.fullmatch(normalized):
+        # "079 123-45" style input is one phone number
+        tokens = [phone_digits(normalized)]
+    else:
+        tokens = normalized.split()
+    conditions = [
+        {"search_terms": token} if token.isdigit() and len(token) < SEARCH_MIN_DIGITS
+        else {"search_terms": re.compile("^" + re.escape(token))}
+        for token in tokens if token
+    ]
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+async def rebuild_search_terms(batch_size: int = 1000, only_missing: bool = False) -> int:
+    # Backfill search_terms for orders written before they existed
+    updated = 0
+    for collection in ORDER_TIERS:
+        last_id = None
+        while True:
+            query = {} if last_id is None else {"_id": {"$gt": last_id}}
+            if only_missing:
+                query["search_terms"] = {"$exists": False}
+            projection = {field: 1 for field in SEARCH_FIELDS}
+            batch = await db[collection].find(query, projection).sort("_id", 1).limit(batch_size).to_list(batch_size)
+            if not batch:
+                break
+            result = await db[collection].bulk_write([
+                UpdateOne({"_id": doc["_id"]}, {"$set": {"search_terms": order_search_terms(doc)}})
+                for doc in batch
+            ], ordered=False)
+            updated += result.modified_count
+            last_id = batch[-1]["_id"]
+    return updated
+
+# ============= Datetime Migration =============
+
+# Fields that older code wrote as ISO strings; "python manage.py
+# migrate-datetimes" converts them to BSON dates in batches. Progress is
+# checkpointed in the migrations collection, so an interrupted run resumes
+# where it stopped; a finished pass clears its checkpoint so a later run
+# picks up any stragglers.
+DATETIME_FIELDS = [
+    ("orders", "created_at"),
+    ("orders", "updated_at"),
+    ("orders_archive", "created_at"),
+    ("orders_archive", "updated_at"),
+    ("order_history", "timestamp"),
+    ("users", "created_at"),
+]
+
+def parse_stored_datetime(value: str) -> datetime:
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+async def migrate_datetime_field(collection: str, field: str, batch_size: int = 1000) -> tuple[int, int]:
+    checkpoint_id = f"datetimes:{collection}.{field}"
+    checkpoint = await db.migrations.find_one({"_id": checkpoint_id})
+    last_id = checkpoint["last_id"] if checkpoint else None
+
+    converted = failed = 0
+    while True:
+        query = {field: {"$type": "string"}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        batch = await db[collection].find(query, {field: 1}).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+
+        updates = []
+        for doc in batch:
+            try:
+                value = parse_stored_datetime(doc[field])
+            except ValueError:
+                failed += 1
+                logger.warning("Unparseable %s.%s on %s: %r", collection, field, doc["_id"], doc[field])
+                continue
+            # Only replace the exact string we read, never a newer write
+            updates.append(UpdateOne({"_id": doc["_id"], field: doc[field]}, {"$set": {field: value}}))
+        if updates:
+            result = await db[collection].bulk_write(updates, ordered=False)
+            converted += result.modified_count
+
+        last_id = batch[-1]["_id"]
+        await db.migrations.update_one({"_id": checkpoint_id}, {"$set": {"last_id": last_id}}, upsert=True)
+
+    await db.migrations.delete_one({"_id": checkpoint_id})
+    return converted, failed
+
+# ============= Archive =============
+
+# Finished orders older than ARCHIVE_AFTER_DAYS, and every order of a deleted
+# company, are moved from orders (hot) to orders_archive (cold) by "python
+# manage.py archive-orders". Dashboard routes read the hot tier only;
+# reports, exports and search read both. Counters and daily rollups keep
+# counting archived orders, and history is not moved, so neither changes.
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_LOCK_TTL = 600
+ORDER_TIERS = ("orders", "orders_archive")
+
+def tier_sort_key(doc: dict, fields: list[str]) -> tuple:
+    return tuple(doc[field] for field in fields)
+
+async def merge_tiers(cursors: list, fields: list[str], descending: bool = False):
+    # Each cursor is sorted on `fields`; yields their union in the same order
+    heads = {}
+    for index, cursor in enumerate(cursors):
+        doc = await anext(cursor, None)
+        if doc is not None:
+            heads[index] = doc
+    pick = max if descending else min
+    while heads:
+        index = pick(heads, key=lambda i: tier_sort_key(heads[i], fields))
+        yield heads[index]
+        doc = await anext(cursors[index], None)
+        if doc is None:
+            del heads[index]
+        else:
+            heads[index] = doc
+
+def tier_cursors(query: dict, projection: dict, fields: list[str], descending: bool = False, limit: int = 0) -> list:
+    direction = -1 if descending else 1
+    return [
+        db[collection].find(query, projection).sort([(field, direction) for field in fields]).limit(limit)
+        for collection in ORDER_TIERS
+    ]
+
+async def archive_orders(older_than_days: int = ARCHIVE_AFTER_DAYS, batch_size: int = 500) -> dict:
+    token = await acquire_lock("archive-orders", ARCHIVE_LOCK_TTL)
+    if token is None:
+        raise RuntimeError("Another archive-orders run is in progress")
+    try:
+        return await move_to_archive(older_than_days, batch_size, token)
+    finally:
+        await release_lock("archive-orders", token)
+
+async def move_to_archive(older_than_days: int, batch_size: int, token: str) -> dict:
+    # Copy a batch to the archive, then delete each order from the hot tier
+    # only if unchanged since it was read. The copy of every order this run
+    # did not delete itself is removed again: edited ones are retried on a
+    # later run, ones deleted in between stay deleted. Every step is
+    # idempotent, so an interrupted run is simply run again; the lock keeps
+    # two runs from removing each other's copies.
+    cutoff = datetime.now(timezone.utc) - timedelta(days=older_than_days)
+    live_companies = set(await db.users.distinct("id", {"role": "company"}))
+    deleted_companies = [c for c in await db.orders.distinct("company_id") if c is not None and c not in live_companies]
+    criteria = [{"status": {"$in": REPORT_STATUSES}, "created_at": {"$lt": cutoff}}]
+    if deleted_companies:
+        criteria.append({"company_id": {"$in": deleted_companies}})
+
+    moved = 0
+    skipped = []
+    while True:
+        query = {"$or": criteria}
+        if skipped:
+            query["_id"] = {"$nin": skipped}
+        batch = await db.orders.find(query).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+
+        archived_at = datetime.now(timezone.utc)
+        await db.orders_archive.bulk_write([
+            ReplaceOne({"_id": doc["_id"]}, {**doc, "archived_at": archived_at}, upsert=True)
+            for doc in batch
+        ], ordered=False)
+        # One delete per order: a batched delete only reports a total, and
+        # a concurrent delete_order must not be mistaken for ours
+        results = await asyncio.gather(*(
+            db.orders.delete_one({"_id": doc["_id"], "updated_at": doc["updated_at"]})
+            for doc in batch
+        ))
+        kept = [doc["_id"] for doc, result in zip(batch, results) if not result.deleted_count]
+        moved += len(batch) - len(kept)
+
+        if kept:
+            still_hot = [doc["_id"] async for doc in db.orders.find({"_id": {"$in": kept}}, {"_id": 1})]
+            await db.orders_archive.delete_many({"_id": {"$in": kept}})
+            skipped.extend(still_hot)
+
+        await bump_order_versions(*{doc["company_id"] for doc in batch})
+        await renew_lock("archive-orders", token, ARCHIVE_LOCK_TTL)
+
+    await refresh_archive_counters()
+    return {"moved": moved, "skipped": len(skipped), "deleted_companies": len(deleted_companies)}
+
+# ============= Report Cache =============
+
+# A day's report only changes while orders are still being created that day,
+# or when an order created that day is edited or deleted. Reports of closed
+# days (REPORT_CLOSE_GRACE past UTC midnight) are kept serialized per
+# (day, status set) in report_cache, with an in-process LRU in front.
+# report_days holds a generation per day: update_order and delete_order bump
+# it, and an entry is served only while its generation is current, so the
+# LRUs of other workers and reports computed during an edit never go stale.
+REPORT_CACHE_ENABLED = os.environ.get("REPORT_CACHE_ENABLED", "1").lower() not in ("0", "false", "no")
+REPORT_CACHE_BYTES = int(os.environ.get("REPORT_CACHE_MB", "64")) * 1024 * 1024
+REPORT_CLOSE_GRACE = timedelta(minutes=int(os.environ.get("REPORT_CLOSE_GRACE_MINUTES", "10")))
+REPORT_MAX_DAYS = int(os.environ.get("REPORT_MAX_DAYS", "62"))
+# Stay clear of the 16MB document limit; larger reports are cached in memory only
+REPORT_PERSIST_MAX_BYTES = 15 * 1024 * 1024
+
+# key -> (generation, JSON array bytes), bounded by total body size
+report_cache = LRUCache(maxsize=REPORT_CACHE_BYTES, getsizeof=lambda entry: len(entry[1]))
+report_cache_lookups = registry.counter(
+    "report_cache_lookups_total", "Report days by where they were served from", ("result",))
+report_cache_invalidations = registry.counter(
+    "report_cache_invalidations_total", "Report days invalidated by order edits and deletes")
+registry.callback_gauge("report_cache_entries", "Reports held in the in-process LRU", lambda: len(report_cache))
+registry.callback_gauge("report_cache_bytes", "Bytes of reports held in the in-process LRU", lambda: report_cache.currsize)
+
+def report_cache_key(day: str, statuses: tuple) -> str:
+    return f"{day}|{','.join(statuses)}"
+
+def report_day_closed(day: str) -> bool:
+    _, end = day_bounds(day)
+    return end + REPORT_CLOSE_GRACE < datetime.now(timezone.utc)
+
+async def build_report_day(day: str, statuses: tuple) -> bytes:
+    start, end = day_bounds(day)
+    # An order being archived can briefly sit in both tiers; keep one copy
+    orders = {}
+    for collection in ORDER_TIERS:
+        cursor = db[collection].find({
+            "status": {"$in": list(statuses)},
+            "created_at": {"$gte": start, "$lte": end}
+        }, {"archived_at": 0, "search_terms": 0})
+        async for doc in cursor:
+            doc["id"] = str(doc["_id"])
+            orders.setdefault(doc.pop("_id"), doc)
+    return FastJSONResponse([order_out(order) for order in orders.values()]).body
+
+def remember_report(key: str, generation: int, body: bytes):
+    if len(body) <= report_cache.maxsize:
+        report_cache[key] = (generation, body)
+
+async def report_day_bodies(days: list[str], statuses: tuple) -> list[bytes]:
+    # One JSON array per day, in order
+    closed = [day for day in days if report_day_closed(day)] if REPORT_CACHE_ENABLED else []
+    generations = {}
+    if closed:
+        # Read before any order so an edit landing mid-build leaves the
+        # entry on an old generation
+        async for doc in db.report_days.find({"_id": {"$in": closed}}):
+            generations[doc["_id"]] = doc["generation"]
+
+    bodies = {}
+    for day in closed:
+        entry = report_cache.get(report_cache_key(day, statuses))
+        if entry is not None and entry[0] == generations.get(day, 0):
+            bodies[day] = entry[1]
+            report_cache_lookups.inc("memory_hit")
+
+    wanted = {report_cache_key(day, statuses): day for day in closed if day not in bodies}
+    if wanted:
+        async for doc in db.report_cache.find({"_id": {"$in": list(wanted)}}):
+            day = wanted[doc["_id"]]
+            if doc["generation"] == generations.get(day, 0):
+                bodies[day] = doc["body"]
+                remember_report(doc["_id"], doc["generation"], doc["body"])
+                report_cache_lookups.inc("db_hit")
+
+    missing = [day for day in days if day not in bodies]
+    built = await asyncio.gather(*(build_report_day(day, statuses) for day in missing))
+    closed = set(closed)
+    writes = []
+    for day, body in zip(missing, built):
+        bodies[day] = body
+        if day not in closed:
+            report_cache_lookups.inc("uncached")
+            continue
+        report_cache_lookups.inc("miss")
+        key = report_cache_key(day, statuses)
+        generation = generations.get(day, 0)
+        remember_report(key, generation, body)
+        if len(body) <= REPORT_PERSIST_MAX_BYTES:
+            writes.append(ReplaceOne({"_id": key}, {
+                "day": day,
+                "statuses": list(statuses),
+                "generation": generation,
+                "body": body,
+                "created_at": datetime.now(timezone.utc)
+            }, upsert=True))
+    if writes:
+        await db.report_cache.bulk_write(writes, ordered=False)
+
+    return [bodies[day] for day in days]
+
+async def invalidate_report_day(day: str):
+    # Today is never cached, so edits to today's orders cost nothing here
+    if day >= datetime.now(timezone.utc).strftime("%Y-%m-%d"):
+        return
+    await db.report_days.update_one({"_id": day}, {"$inc": {"generation": 1}}, upsert=True)
+    await db.report_cache.delete_many({"day": day})
+    for key in [key for key in report_cache if key.startswith(f"{day}|")]:
+        report_cache.pop(key, None)
+    report_cache_invalidations.inc()
+
+async def clear_report_cache():
+    # For bulk rewrites of order data outside the routes
+    await db.report_days.update_many({}, {"$inc": {"generation": 1}})
+    await db.report_cache.delete_many({})
+    report_cache.clear()
+
+# ============= Admission Control =============
+
+# Concurrency-limited route classes; everything else is only rate limited.
+# ADMISSION_LIMITS is "class=limit:budget_seconds,..."; auth defaults to twice
+# the bcrypt pool so logins queue there rather than on the event loop.
+ADMISSION_ROUTES = [
+    ("POST", r"/api/auth/(login|register|change-password)", "auth"),
+    ("POST", r"/api/companies/[^/]+/reset-password", "auth"),
+    ("GET", r"/api/orders/(report|export|report/export|search)", "heavy"),
+    ("GET", r"/api/reports/summary", "heavy"),
+    ("POST", r"/api/orders/(bulk|history/batch)", "heavy"),
+    ("POST", r"/api/orders", "write"),
+    ("PUT", r"/api/orders/[^/]+", "write"),
+    ("DELETE", r"/api/orders/[^/]+", "write"),
+    ("DELETE", r"/api/companies/[^/]+", "write"),
+]
+
+def admission_key(scope) -> str:
+    # Per-user bucket from the verified JWT sub; anonymous callers (login)
+    # are bucketed by client address
+    token = Request(scope).cookies.get("access_token")
+    if token:
+        try:
+            return "user:" + jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])["sub"]
+        except (jwt.PyJWTError, KeyError):
+            pass
+    client_addr = scope.get("client")
+    return "ip:" + (client_addr[0] if client_addr else "unknown")
+
+admission = AdmissionControl(
+    ADMISSION_ROUTES,
+    parse_limits(os.environ.get("ADMISSION_LIMITS", f"auth={PASSWORD_WORKERS * 2}:2,heavy=4:5,write=64:1")),
+    rate=float(os.environ.get("RATE_LIMIT_RPS", "20")),
+    burst=float(os.environ.get("RATE_LIMIT_BURST", "40")),
+    key_func=admission_key,
+    enabled=os.environ.get("ADMISSION_CONTROL", "1").lower() not in ("0", "false", "no"),
+)
+app.add_middleware(AdmissionMiddleware, control=admission)
+
 # ============= Routes =============
 
 @api_router.get("/")
@@ -260,21 +1302,22 @@ async def register(user_data: UserCreate, current_user: dict = Depends(get_curre
     # Create user
     user = User(
         username=user_data.username,
-        password_hash=hash_password(user_data.password),
+        password_hash=await run_password_task(hash_password, user_data.password),
         role=user_data.role,
         company_name=user_data.company_name
     )
     
     doc = user.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     await db.users.insert_one(doc)
+    company_directory.invalidate()
+    await bump_versions(COMPANIES_VERSION)
     
     return {"message": "User created successfully", "username": user.username}
 
 @api_router.post("/auth/login")
 async def login(credentials: UserLogin, response: Response):
     user = await db.users.find_one({"username": credentials.username}, {"_id": 0})
-    if not user or not verify_password(credentials.password, user["password_hash"]):
+    if not user or not await run_password_task(verify_password, credentials.password, user["password_hash"]):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     token = create_access_token({"sub": user["id"], "role": user["role"]})
@@ -308,7 +1351,6 @@ async def login(credentials: UserLogin, response: Response):
 
 @api_router.post("/auth/logout")
 async def logout(response: Response):
-    print("delete")
     response.delete_cookie("access_token")
     return {"message": "Logged out"}
 
@@ -325,56 +1367,183 @@ async def get_user(current_user: dict = Depends(get_current_user)):
     }
     
 @api_router.get("/users")
-async def get_users():
-    collection= db["users"]
-    users_collection = collection.find({})
-    users = []
-    async for doc in users_collection:
-        # stores mongodb primary key in new one called "id"
-        doc["id"] = str(doc["_id"])
-        # remove the original _id i have new one called "id"
-        del doc["_id"]
-        # push document into users list
-        users.append(doc)
-    return users 
+async def get_users(
+        response: Response,
+        limit: int = Query(100, ge=1, le=500),
+        after: Optional[str] = Query(None, description="X-Next-Cursor from the previous page (a username)"),
+        current_user: dict = Depends(get_current_user)
+):
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Admin only")
+
+    # Never return password hashes; paged by the unique username index
+    query = {"username": {"$gt": after}} if after else {}
+    users = await db.users.find(query, {"_id": 0, "password_hash": 0}) \
+        .sort("username", 1) \
+        .limit(limit + 1) \
+        .to_list(limit + 1)
+
+    if len(users) > limit:
+        users = users[:limit]
+        response.headers["X-Next-Cursor"] = users[-1]["username"]
+    return users
 
 @api_router.post("/auth/change-password")
 async def change_password(password_data: PasswordChange, current_user: dict = Depends(get_current_user)):
     # Verify current password
     user = await db.users.find_one({"id": current_user["id"]}, {"_id": 0})
-    if not user or not verify_password(password_data.current_password, user["password_hash"]):
+    if not user or not await run_password_task(verify_password, password_data.current_password, user["password_hash"]):
         raise HTTPException(status_code=401, detail="كلمة المرور الحالية غير صحيحة")
     
     # Update password
-    new_hash = hash_password(password_data.new_password)
+    new_hash = await run_password_task(hash_password, password_data.new_password)
     await db.users.update_one({"id": current_user["id"]}, {"$set": {"password_hash": new_hash}})
+    invalidate_user(current_user["id"])
     
     return {"message": "تم تغيير كلمة المرور بنجاح"}
 
 # Get order Routes
 @api_router.get("/orders", response_model=List[Order])
-async def get_orders(current_user: dict = Depends(get_current_user)):
+async def get_orders(
+        request: Request,
+        response: Response,
+        limit: Optional[int] = Query(None, ge=1, le=500, description="Page size; enables cursor pagination"),
+        after: Optional[str] = Query(None, description="Cursor from the X-Next-Cursor header of the previous page"),
+        current_user: dict = Depends(get_current_user)
+):
+    # Token for /orders/changes, taken before reading so nothing falls in between
+    response.headers["X-Sync-Token"] = current_sync_token()
+
+    # Version read before the data: a write landing in between only causes
+    # one extra full response later, never a stale 304
+    etag = await version_etag(version_key(current_user))
+    if etag_matches(request, etag):
+        return not_modified(etag, response)
+    set_etag(response, etag)
+
     query = {}
     
     # If company user, only show their orders
     if current_user["role"] == "company":
         query["company_id"] = current_user["id"]
-    
-    orders = await db.orders.find(query, {"_id": 0}).to_list(10000)
-    
-    # Convert ISO strings to datetime
-    for order in orders:
-        if isinstance(order['created_at'], str):
-            order['created_at'] = datetime.fromisoformat(order['created_at'])
-        if isinstance(order['updated_at'], str):
-            order['updated_at'] = datetime.fromisoformat(order['updated_at'])
 
-    
+    # Cursor pagination: sorted and limited in Mongo, served by the
+    # (company_id, created_at, id) / (created_at, id) indexes
+    if limit is not None:
+        if after:
+            after_created_at, after_id = decode_cursor(after)
+            query["$or"] = [
+                {"created_at": {"$lt": after_created_at}},
+                {"created_at": after_created_at, "id": {"$lt": after_id}},
+            ]
+            if isinstance(after_created_at, datetime):
+                query["$or"].append({"created_at": {"$type": "string"}})
+
+        orders = await db.orders.find(query, {"_id": 0}) \
+            .sort([("created_at", -1), ("id", -1)]) \
+            .limit(limit + 1) \
+            .to_list(limit + 1)
+
+        if len(orders) > limit:
+            orders = orders[:limit]
+            last = orders[-1]
+            response.headers["X-Next-Cursor"] = encode_cursor(last["created_at"], last["id"])
+
+        return orders_response(orders, response)
+
     # Sort by created_at descending
-    orders.sort(key=lambda x: x['created_at'], reverse=True)
+    orders = await db.orders.find(query, {"_id": 0}) \
+        .sort([("created_at", -1), ("id", -1)]) \
+        .to_list(10000)
     
-    return orders
+    return orders_response(orders, response)
+
+@api_router.get("/orders/search", response_model=List[Order])
+async def search_orders(
+        response: Response,
+        q: str = Query(..., min_length=2, description="Order number, phone digits, or customer/area name"),
+        company_id: Optional[str] = Query(None, description="Admin only; company users always search their own orders"),
+        limit: int = Query(50, ge=1, le=200),
+        current_user: dict = Depends(get_current_user)
+):
+    query = search_query(q)
+    if query is None:
+        return []
 
+    # Same scoping as get_orders
+    if current_user["role"] == "company":
+        query["company_id"] = current_user["id"]
+    elif company_id:
+        query["company_id"] = company_id
+
+    # Sorting every match of a broad prefix on created_at would fetch them
+    # all, so each tier reads at most SEARCH_SCAN_LIMIT matches in index
+    # order and the newest `limit` of those are returned. X-Search-Truncated
+    # tells the client the query should be narrowed.
+    projection = {"_id": 0, "search_terms": 0, "archived_at": 0}
+    tiers = await asyncio.gather(*(
+        db[collection].find(query, projection).limit(SEARCH_SCAN_LIMIT).to_list(SEARCH_SCAN_LIMIT)
+        for collection in ORDER_TIERS
+    ))
+    if any(len(docs) >= SEARCH_SCAN_LIMIT for docs in tiers):
+        response.headers["X-Search-Truncated"] = "true"
+    orders = sorted((doc for docs in tiers for doc in docs),
+                    key=lambda doc: tier_sort_key(doc, ["created_at", "id"]), reverse=True)
+
+    return orders_response(orders[:limit], response)
+
+@api_router.get("/orders/changes")
+async def get_order_changes(
+        since: str = Query(..., description="X-Sync-Token from /orders or token from the previous sync"),
+        limit: int = Query(1000, ge=1, le=5000),
+        current_user: dict = Depends(get_current_user)
+):
+    since_dt, after_id = decode_sync_token(since)
+    next_token = current_sync_token()
+
+    query = {"updated_at": {"$gte": since_dt}}
+    if after_id:
+        # Resuming a full page: skip what was already sent at since_dt
+        query = {"$or": [
+            {"updated_at": {"$gt": since_dt}},
+            {"updated_at": since_dt, "id": {"$gt": after_id}},
+        ]}
+    deleted_query = {"action": "deleted", "timestamp": {"$gte": since_dt}}
+    archived_query = {"archived_at": {"$gte": since_dt}}
+    if current_user["role"] == "company":
+        query["company_id"] = current_user["id"]
+        deleted_query["changes.order.company_id"] = current_user["id"]
+        archived_query["company_id"] = current_user["id"]
+
+    orders = await db.orders.find(query, {"_id": 0}) \
+        .sort([("updated_at", 1), ("id", 1)]) \
+        .limit(limit) \
+        .to_list(limit)
+
+    # Page is full: resume from the last change returned
+    has_more = len(orders) == limit
+    if has_more:
+        last = orders[-1]
+        next_token = encode_sync_token(last["updated_at"].replace(tzinfo=timezone.utc), last["id"])
+
+    deleted = await db.order_history.find(deleted_query, {"_id": 0, "order_id": 1}) \
+        .to_list(SYNC_TOMBSTONE_LIMIT + 1)
+    # Archived orders leave the hot tier, so delta sync drops them too
+    archived = await db.orders_archive.find(archived_query, {"_id": 0, "id": 1}) \
+        .to_list(SYNC_TOMBSTONE_LIMIT + 1)
+
+    if len(deleted) > SYNC_TOMBSTONE_LIMIT or len(archived) > SYNC_TOMBSTONE_LIMIT:
+        # A partial tombstone list would leave orders behind for good: the
+        # client reloads /orders and continues from its X-Sync-Token
+        return {"orders": [], "deleted": [], "token": None, "has_more": False, "resync": True}
+
+    return {
+        "orders": [Order(**order) for order in orders],
+        "deleted": list({entry["order_id"] for entry in deleted} | {entry["id"] for entry in archived}),
+        "token": next_token,
+        "has_more": has_more,
+        "resync": False
+    }
 
 # async def notify_company(company_id: str, new_order):
 #     connections = company_clients.get(str(company_id))
@@ -415,9 +1584,7 @@ async def create_order(order_data: OrderCreate, current_user: dict = Depends(get
 
     # Case 2: admin adding an order
     else:
-        company = await db.users.find_one({
-            "company_name": order_data.company_name
-        })
+        company = await company_directory.find_by_name(order_data.company_name)
 
         # if company does not exist, raise a message telling that
         if not company:
@@ -437,215 +1604,549 @@ async def create_order(order_data: OrderCreate, current_user: dict = Depends(get
     doc['created_at'] = datetime.now(timezone.utc)
     doc['updated_at'] = datetime.now(timezone.utc)
                 
-    await db.orders.insert_one(doc)
-                
+    await db.orders.insert_one({**doc, "search_terms": order_search_terms(doc)})
+
     # Create history entry - clean doc for JSON serialization
     clean_doc = {k: v for k, v in doc.items() if k != '_id'}
-
-    history = OrderHistory(
-        order_id=order.id,
-        action="created",
-        changes=clean_doc,
-        user_id=current_user["id"],
-        username=current_user["username"]
+    await asyncio.gather(
+        record_history(history_entry(order.id, "created", clean_doc, current_user)),
+        bump_order_counters(company_id, None, doc["status"]),
+        apply_rollups(None, doc),
+        bump_order_versions(company_id),
     )
-                
-    history_doc = history.model_dump()
-    history_doc['timestamp'] = history_doc['timestamp'].isoformat()
-    await db.order_history.insert_one(history_doc)
 
     # Real-Time connection
-    connections = company_clients.get(str(company_id), [])
     message = {
         "type": "new_order",
         "message": "You have a new order",
         "order": jsonable_encoder(clean_doc)
     }
-
-    for ws in connections:
-        try:
-            await ws.send_json(message)
-        except:
-            pass
+    await hub.publish(str(company_id), message)
                 
     return order
         
+BULK_MAX_ROWS = 10000
+
+async def read_bulk_rows(request: Request) -> list:
+    # JSON array of orders, or a CSV upload (Content-Type: text/csv) whose
+    # header row uses the OrderCreate field names
+    body = await request.body()
+    if request.headers.get("content-type", "").startswith("text/csv"):
+        try:
+            if b"\x00" in body:
+                # UTF-16 exports and binary files; csv only rejects NUL before 3.11
+                raise csv.Error("NUL byte in CSV")
+            reader = csv.DictReader(io.StringIO(body.decode("utf-8-sig")))
+            # Empty cells mean "not given" so optional fields keep their defaults
+            return [{k: v for k, v in row.items() if k and v not in ("", None)} for row in reader]
+        except (UnicodeDecodeError, csv.Error):
+            # Non-UTF-8 exports (e.g. Excel's legacy code pages)
+            raise HTTPException(status_code=400, detail="CSV file must be UTF-8 encoded text")
+    try:
+        rows = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Body must be a JSON array or a CSV file")
+    if not isinstance(rows, list):
+        raise HTTPException(status_code=400, detail="Body must be a JSON array or a CSV file")
+    return rows
+
+@api_router.post("/orders/bulk")
+async def create_orders_bulk(request: Request, current_user: dict = Depends(get_current_user)):
+    rows = await read_bulk_rows(request)
+    if len(rows) > BULK_MAX_ROWS:
+        raise HTTPException(status_code=413, detail=f"At most {BULK_MAX_ROWS} orders per request")
+
+    errors = []
+    valid: list[tuple[int, OrderCreate]] = []
+    for row_number, row in enumerate(rows, start=1):
+        try:
+            valid.append((row_number, OrderCreate.model_validate(row)))
+        except ValidationError as e:
+            errors.append({"row": row_number, "errors": e.errors(include_url=False, include_context=False)})
+
+    # Admin rows name their company; resolve them from the directory
+    companies = {}
+    if current_user["role"] != "company":
+        for name in {order_data.company_name for _, order_data in valid}:
+            company = await company_directory.find_by_name(name)
+            if company:
+                companies[name] = company
+
+    now = datetime.now(timezone.utc)
+    rows_by_id: dict[str, int] = {}
+    docs = []
+    for row_number, order_data in valid:
+        if current_user["role"] == "company":
+            company_id, company_name = current_user["id"], current_user["company_name"]
+        elif order_data.company_name in companies:
+            company = companies[order_data.company_name]
+            company_id, company_name = company["id"], company["company_name"]
+        else:
+            errors.append({"row": row_number, "errors": [{"msg": "Company not found"}]})
+            continue
+
+        doc = Order(
+            **order_data.model_dump(exclude={"company_id", "company_name"}),
+            company_id=company_id,
+            company_name=company_name,
+            created_at=now,
+            updated_at=now
+        ).model_dump()
+        rows_by_id[doc["id"]] = row_number
+        docs.append(doc)
+
+    inserted = docs
+    if docs:
+        try:
+            await db.orders.insert_many(
+                [{**doc, "search_terms": order_search_terms(doc)} for doc in docs],
+                ordered=False
+            )
+        except BulkWriteError as e:
+            failed = {error["index"]: error["errmsg"] for error in e.details["writeErrors"]}
+            for index, message in failed.items():
+                errors.append({"row": rows_by_id[docs[index]["id"]], "errors": [{"msg": message}]})
+            inserted = [doc for index, doc in enumerate(docs) if index not in failed]
+
+    if inserted:
+        await record_history(*[history_entry(doc["id"], "created", doc, current_user) for doc in inserted])
+
+        await bump_order_counters_many([(doc["company_id"], None, doc["status"]) for doc in inserted])
+        await db.daily_rollups.bulk_write([rollup_update(doc, 1) for doc in inserted], ordered=False)
+        await bump_order_versions(*{doc["company_id"] for doc in inserted})
+
+        # One coalesced event per company
+        per_company: dict[str, list] = {}
+        for doc in inserted:
+            per_company.setdefault(str(doc["company_id"]), []).append(jsonable_encoder(doc))
+        for company_id, orders in per_company.items():
+            await hub.publish(company_id, {
+                "type": "new_orders",
+                "message": f"You have {len(orders)} new orders",
+                "orders": orders
+            })
+
+    errors.sort(key=lambda x: x["row"])
+    return {
+        "created": len(inserted),
+        "failed": len(errors),
+        "ids": [doc["id"] for doc in inserted],
+        "errors": errors
+    }
+
 @api_router.get("/orders/report", response_model=List[Order])
 async def get_report(
-        date: str = Query(..., descritption="Date in YYYY-MM-DD format"),
+        date: Optional[str] = Query(None, description="Date in YYYY-MM-DD format"),
+        date_from: Optional[str] = Query(None, alias="from", description="YYYY-MM-DD, inclusive; with to instead of date"),
+        date_to: Optional[str] = Query(None, alias="to", description="YYYY-MM-DD, inclusive"),
+        status_filter: Optional[List[str]] = Query(None, alias="status", description="Defaults to completed and cancelled"),
         current_user: dict = Depends(get_current_user)
 ):
     if current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Only admins can create report")
-    collection= db["orders"]
-
-    try:
-        report_date = datetime.strptime(date, "%Y-%m-%d")
-    except ValueError:
-        raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
-    
-
-    report_date = datetime.strptime(date, "%Y-%m-%d")
+    if date:
+        date_from = date_to = date
+    if not date_from or not date_to:
+        raise HTTPException(status_code=400, detail="Pass date, or from and to")
+    first, _ = day_bounds(date_from)
+    last, _ = day_bounds(date_to)
+    span = (last - first).days + 1
+    if span < 1 or span > REPORT_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"A report covers 1 to {REPORT_MAX_DAYS} days")
+
+    statuses = tuple(sorted(set(status_filter or REPORT_STATUSES)))
+    if any(value not in STATUS_COUNTERS for value in statuses):
+        raise HTTPException(status_code=400, detail="Unknown status")
+
+    # Reports cover both the hot and the archive tier, one cached array per
+    # day; they are spliced together without parsing
+    days = [(first + timedelta(days=offset)).strftime("%Y-%m-%d") for offset in range(span)]
+    bodies = await report_day_bodies(days, statuses)
+    items = [body[1:-1] for body in bodies if body != b"[]"]
+    return Response(content=b"[" + b",".join(items) + b"]", media_type="application/json")
+                     
+# ============= Export =============
+
+REPORT_STATUSES = ["تم", "ملغي"]
+EXPORT_FIELDS = list(Order.model_fields)
+EXPORT_BATCH_SIZE = 500
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+def export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+async def stream_orders_csv(cursor):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # BOM so Excel opens the Arabic text as UTF-8
+    buffer.write("\ufeff")
+    writer.writerow(EXPORT_FIELDS)
+    async for doc in cursor:
+        writer.writerow([export_value(doc.get(field)) for field in EXPORT_FIELDS])
+        if buffer.tell() >= EXPORT_CHUNK_BYTES:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+async def stream_orders_ndjson(cursor):
+    chunk = []
+    size = 0
+    async for doc in cursor:
+        line = json.dumps({field: export_value(doc.get(field)) for field in EXPORT_FIELDS}, ensure_ascii=False) + "\n"
+        chunk.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_BYTES:
+            yield "".join(chunk)
+            chunk, size = [], 0
+    yield "".join(chunk)
+
+def export_response(query: dict, export_format: str, filename: str) -> StreamingResponse:
+    # Rows are written straight from the cursors, one batch in memory at a
+    # time; both tiers are merged in created_at order
+    fields = ["created_at", "id"]
+    cursor = merge_tiers([
+        tier.batch_size(EXPORT_BATCH_SIZE) for tier in tier_cursors(query, {"_id": 0}, fields)
+    ], fields)
+    if export_format == "csv":
+        body, media_type = stream_orders_csv(cursor), "text/csv; charset=utf-8"
+    else:
+        body, media_type = stream_orders_ndjson(cursor), "application/x-ndjson"
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{export_format}"'}
+    )
 
-    start = datetime.combine(report_date, time.min).replace(tzinfo=timezone.utc)# 2025-11-19 00:00:00
-    end = datetime.combine(report_date, time.max).replace(tzinfo=timezone.utc)# 2025-11-19 23:59:59.999999
+@api_router.get("/orders/export")
+async def export_orders(
+        format: str = Query("csv", pattern="^(csv|ndjson)$"),
+        company_id: Optional[str] = Query(None, description="Admin only; company users always get their own orders"),
+        status: Optional[List[str]] = Query(None),
+        date_from: Optional[str] = Query(None, alias="from", description="YYYY-MM-DD, inclusive"),
+        date_to: Optional[str] = Query(None, alias="to", description="YYYY-MM-DD, inclusive"),
+        current_user: dict = Depends(get_current_user)
+):
+    query = {}
+    if current_user["role"] == "company":
+        query["company_id"] = current_user["id"]
+    elif company_id:
+        query["company_id"] = company_id
+
+    if status:
+        query["status"] = {"$in": status}
+
+    created_at = {}
+    if date_from:
+        created_at["$gte"] = day_bounds(date_from)[0]
+    if date_to:
+        created_at["$lte"] = day_bounds(date_to)[1]
+    if created_at:
+        query["created_at"] = created_at
+
+    return export_response(query, format, "orders")
+
+@api_router.get("/orders/report/export")
+async def export_report(
+        date: str = Query(..., description="Date in YYYY-MM-DD format"),
+        format: str = Query("csv", pattern="^(csv|ndjson)$"),
+        current_user: dict = Depends(get_current_user)
+):
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Only admins can create report")
 
-    orders_cursor = collection.find({
-        "status": {"$in": ["تم", "ملغي"]},  # حسب حالة الطلب
-        "created_at": {"$gte": start, "$lte": end}  # فلتر حسب اليوم
-    })
+    start, end = day_bounds(date)
+    query = {
+        "status": {"$in": REPORT_STATUSES},
+        "created_at": {"$gte": start, "$lte": end}
+    }
+    return export_response(query, format, f"report-{date}")
 
-    orders = []
+def order_write_filter(order_id: str, current_user: dict) -> dict:
+    # Company users may only touch their own orders; checked inside the write
+    query = {"id": order_id}
+    if current_user["role"] == "company":
+        query["company_id"] = current_user["id"]
+    return query
 
-    async for doc in orders_cursor:
-        # stores mongodb primary key in new one called "id"
-        doc["id"] = str(doc["_id"])
-        # remove the original _id i have new one called "id"
-        del doc["_id"]
-        # push document into users list
-        orders.append(doc)
-    return orders
-                     
-@api_router.put("/orders/{order_id}", response_model=Order)
-async def update_order(order_id: str, order_data: OrderUpdate, current_user: dict = Depends(get_current_user)):
-    # Find order
+async def find_writable_order(order_id: str, current_user: dict, forbidden_detail: str) -> dict:
+    # Slow path after a filtered write matched nothing: tell 404 from 403
     order = await db.orders.find_one({"id": order_id}, {"_id": 0})
     if not order:
+        archived = await db.orders_archive.find_one({"id": order_id}, {"_id": 0, "company_id": 1})
+        if archived and (current_user["role"] != "company" or archived["company_id"] == current_user["id"]):
+            raise HTTPException(status_code=409, detail="الطلب مؤرشف ولا يمكن تعديله")
         raise HTTPException(status_code=404, detail="الطلب غير موجود")
-    
-    # Check permission
     if current_user["role"] == "company" and order["company_id"] != current_user["id"]:
-        raise HTTPException(status_code=403, detail="ليس لديك صلاحية لتعديل هذا الطلب")
-    
+        raise HTTPException(status_code=403, detail=forbidden_detail)
+    return order
+
+@api_router.put("/orders/{order_id}", response_model=Order)
+async def update_order(order_id: str, order_data: OrderUpdate, current_user: dict = Depends(get_current_user)):
+    forbidden = "ليس لديك صلاحية لتعديل هذا الطلب"
+    update_data = order_data.model_dump(exclude_unset=True)
+
+    # Only match when at least one field actually changes, so a no-op edit
+    # does not bump updated_at
+    query = order_write_filter(order_id, current_user)
+    if update_data:
+        query["$or"] = [{key: {"$ne": value}} for key, value in update_data.items()]
+        update_data["updated_at"] = datetime.now(timezone.utc)
+        # One round trip: the pre-image gives the history diff, the
+        # post-image is the pre-image with update_data applied
+        order = await db.orders.find_one_and_update(
+            query,
+            {"$set": update_data},
+            projection={"_id": 0, "search_terms": 0},
+            return_document=ReturnDocument.BEFORE
+        )
+    else:
+        order = None
+
+    if order is None:
+        # Missing, not ours, or nothing to change
+        order = await find_writable_order(order_id, current_user, forbidden)
+        return Order(**order)
+
+    updated_order = {**order, **update_data}
+
     # Track changes
     changes = {}
-    update_data = order_data.model_dump(exclude_unset=True)
-    
     for key, new_value in update_data.items():
-        if key in order and order[key] != new_value:
+        if key != "updated_at" and key in order and order[key] != new_value:
             changes[key] = {"old": order[key], "new": new_value}
-    
-    if not changes:
-        return Order(**order)
-    
-    # Update order
-    update_data["updated_at"] = datetime.now(timezone.utc).isoformat()
-    await db.orders.update_one({"id": order_id}, {"$set": update_data})
-    
-    # Create history entry
-    history = OrderHistory(
-        order_id=order_id,
-        action="updated",
-        changes=changes,
-        user_id=current_user["id"],
-        username=current_user["username"]
-    )
-    
-    history_doc = history.model_dump()
-    history_doc['timestamp'] = history_doc['timestamp'].isoformat()
-    await db.order_history.insert_one(history_doc)
 
-    # Real-Time connection
-    # connections = admin_clients.get(str(admin_id), [])
-    # message = {
-    #     "type": "updated_order",
-    #     "message": "You have a new order",
-    #     "order": jsonable_encoder(update_data)
-    # }
-
-    # for ws in connections:
-    #     try:
-    #         await ws.send_json(message)
-    #     except:
-    #         pass
-    
-    # Get updated order
-    updated_order = await db.orders.find_one({"id": order_id}, {"_id": 0})
-    if isinstance(updated_order['created_at'], str):
-        updated_order['created_at'] = datetime.fromisoformat(updated_order['created_at'])
-    if isinstance(updated_order['updated_at'], str):
-        updated_order['updated_at'] = datetime.fromisoformat(updated_order['updated_at'])
-    
-    return Order(**updated_order)
+    # History, counters and rollups are independent, write them concurrently
+    writes = [bump_order_versions(order["company_id"]), invalidate_report_day(order_day(order))]
+    if changes:
+        writes.append(record_history(history_entry(order_id, "updated", changes, current_user)))
+    if "status" in changes:
+        writes.append(bump_order_counters(order["company_id"], order["status"], updated_order["status"]))
+    # Compared on the contribution, not on changes: a field missing from a
+    # legacy pre-image is not in changes but still moves the totals
+    if rollup_state(order) != rollup_state(updated_order):
+        writes.append(apply_rollups(order, updated_order))
+    if any(key in changes for key in SEARCH_FIELDS):
+        # Guarded by updated_at so a slower, older edit cannot overwrite newer terms
+        writes.append(db.orders.update_one(
+            {"id": order_id, "updated_at": update_data["updated_at"]},
+            {"$set": {"search_terms": order_search_terms(updated_order)}}
+        ))
+    await asyncio.gather(*writes)
+
+    updated = Order(**updated_order)
+    await hub.publish(str(updated.company_id), {
+        "type": "order_updated",
+        "changes": list(changes),
+        "order": jsonable_encoder(updated)
+    })
+    return updated
 
 @api_router.delete("/orders/{order_id}")
 async def delete_order(order_id: str, current_user: dict = Depends(get_current_user)):
-    order = await db.orders.find_one({"id": order_id}, {"_id": 0})
-    if not order:
+    order = await db.orders.find_one_and_delete(
+        order_write_filter(order_id, current_user),
+        projection={"_id": 0, "search_terms": 0}
+    )
+    if order is None:
+        await find_writable_order(order_id, current_user, "ليس لديك صلاحية لحذف هذا الطلب")
+        # Deleted by a concurrent request between the two reads
         raise HTTPException(status_code=404, detail="الطلب غير موجود")
-    
-    # Check permission
-    if current_user["role"] == "company" and order["company_id"] != current_user["id"]:
-        raise HTTPException(status_code=403, detail="ليس لديك صلاحية لحذف هذا الطلب")
-    
-    await db.orders.delete_one({"id": order_id})
-    
-    # Create history entry - clean order data for JSON serialization
-    clean_order = {k: v for k, v in order.items() if k != '_id'}
-    history = OrderHistory(
-        order_id=order_id,
-        action="deleted",
-        changes={"order": clean_order},
-        user_id=current_user["id"],
-        username=current_user["username"]
+
+    await asyncio.gather(
+        record_history(history_entry(order_id, "deleted", {"order": order}, current_user)),
+        bump_order_counters(order["company_id"], order["status"], None),
+        apply_rollups(order, None),
+        bump_order_versions(order["company_id"]),
+        invalidate_report_day(order_day(order)),
     )
-    
-    history_doc = history.model_dump()
-    history_doc['timestamp'] = history_doc['timestamp'].isoformat()
-    await db.order_history.insert_one(history_doc)
+    await hub.publish(str(order["company_id"]), {"type": "order_deleted", "order_id": order_id})
     
     return {"message": "تم حذف الطلب بنجاح"}
 
+def history_projection(include_changes: bool) -> dict:
+    # "changes" holds a full order copy on created/deleted entries
+    return {"_id": 0} if include_changes else {"_id": 0, "changes": 0}
+
 @api_router.get("/orders/{order_id}/history", response_model=List[OrderHistory])
-async def get_order_history(order_id: str, current_user: dict = Depends(get_current_user)):
+async def get_order_history(
+        order_id: str,
+        response: Response,
+        limit: Optional[int] = Query(None, ge=1, le=500, description="Page size; enables cursor pagination"),
+        before: Optional[str] = Query(None, description="Cursor from the X-Next-Cursor header of the previous page"),
+        include_changes: bool = Query(True, description="false leaves out the changes bodies"),
+        current_user: dict = Depends(get_current_user)
+):
     if current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Admin only")
-    
-    history = await db.order_history.find({"order_id": order_id}, {"_id": 0}).to_list(1000)
-    
-    # Convert ISO strings to datetime and ensure no ObjectId fields
-    for entry in history:
-        if isinstance(entry['timestamp'], str):
-            entry['timestamp'] = datetime.fromisoformat(entry['timestamp'])
-        # Remove any potential ObjectId fields that might have slipped through
-        entry.pop('_id', None)
-    
-    history.sort(key=lambda x: x['timestamp'], reverse=True)
+
+    query = {"order_id": order_id}
+    if before:
+        before_timestamp, before_id = decode_cursor(before)
+        query["$or"] = [
+            {"timestamp": {"$lt": before_timestamp}},
+            {"timestamp": before_timestamp, "id": {"$lt": before_id}},
+        ]
+        if isinstance(before_timestamp, datetime):
+            # Unmigrated string timestamps sort after every date when
+            # descending, and $lt on a date never matches them
+            query["$or"].append({"timestamp": {"$type": "string"}})
+
+    # Newest first, sorted by the (order_id, timestamp, id) index
+    page_size = limit + 1 if limit is not None else 1000
+    history = await db.order_history.find(query, history_projection(include_changes)) \
+        .sort([("timestamp", -1), ("id", -1)]) \
+        .limit(page_size) \
+        .to_list(page_size)
+
+    if limit is not None and len(history) > limit:
+        history = history[:limit]
+        last = history[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor(last["timestamp"], last["id"])
     
     return history
 
+@api_router.post("/orders/history/batch")
+async def get_order_history_batch(batch: HistoryBatchRequest, current_user: dict = Depends(get_current_user)):
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Admin only")
+
+    # Latest `limit` entries per order in a single aggregation; $topN keeps
+    # only those per group instead of pushing an order's whole history
+    # (MongoDB 5.2+)
+    pipeline = [{"$match": {"order_id": {"$in": batch.order_ids}}}]
+    if not batch.include_changes:
+        pipeline.append({"$project": {"changes": 0}})
+    pipeline.append({"$group": {"_id": "$order_id", "entries": {"$topN": {
+        "n": batch.limit,
+        "sortBy": {"timestamp": -1, "id": -1},
+        "output": "$$ROOT",
+    }}}})
+
+    result = {order_id: [] for order_id in batch.order_ids}
+    async for row in db.order_history.aggregate(pipeline):
+        entries = []
+        for entry in row["entries"]:
+            entry.pop("_id", None)
+            entries.append(OrderHistory(**entry))
+        result[row["_id"]] = entries
+    return result
+
 @api_router.get("/stats")
-async def get_stats(current_user: dict = Depends(get_current_user)):
+async def get_stats(request: Request, response: Response, current_user: dict = Depends(get_current_user)):
+    etag = await version_etag(version_key(current_user))
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    set_etag(response, etag)
+
     query = {}
     if current_user["role"] == "company":
         query["company_id"] = current_user["id"]
-    
-    total = await db.orders.count_documents(query)
-    ongoing = await db.orders.count_documents({**query, "status": "جاري"})
-    completed = await db.orders.count_documents({**query, "status": "تم"})
-    cancelled = await db.orders.count_documents({**query, "status": "ملغي"})
-    
+
+    if USE_STATS_COUNTERS:
+        counters_id = query.get("company_id", ALL_COMPANIES)
+        counters = await db.order_counters.find_one({"_id": counters_id}, {"_id": 0})
+        stats = empty_stats()
+        stats.update(counters or {})
+        return stats
+
+    return await aggregate_stats(query)
+
+@api_router.get("/cache/users")
+async def get_user_cache_stats(current_user: dict = Depends(get_current_user)):
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Admin only")
+
     return {
-        "total": total,
-        "ongoing": ongoing,
-        "completed": completed,
-        "cancelled": cancelled
+        "enabled": USER_CACHE_ENABLED,
+        "size": len(user_cache),
+        "maxsize": user_cache.maxsize,
+        "ttl": user_cache.ttl,
+        **user_cache_stats
     }
 
+@api_router.get("/auth/hashing-stats")
+async def get_hashing_stats(current_user: dict = Depends(get_current_user)):
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Admin only")
+
+    return {
+        "executor": type(password_executor).__name__,
+        "workers": PASSWORD_WORKERS,
+        **password_pool_stats
+    }
+
+@api_router.get("/reports/summary")
+async def get_report_summary(
+        date_from: str = Query(..., alias="from", description="YYYY-MM-DD, inclusive"),
+        date_to: str = Query(..., alias="to", description="YYYY-MM-DD, inclusive"),
+        company_id: Optional[str] = Query(None, description="Admin only; company users always get their own totals"),
+        current_user: dict = Depends(get_current_user)
+):
+    # Validate both days
+    day_bounds(date_from)
+    day_bounds(date_to)
+
+    query = {"day": {"$gte": date_from, "$lte": date_to}}
+    if current_user["role"] == "company":
+        query["company_id"] = current_user["id"]
+    elif company_id:
+        query["company_id"] = company_id
+
+    totals = empty_rollup()
+    by_day: dict[str, dict] = {}
+    by_company: dict[str, dict] = {}
+    by_area: dict[str, dict] = {}
+    async for row in db.daily_rollups.find(query, {"_id": 0}):
+        add_rollup(totals, row)
+        add_rollup(by_day.setdefault(row["day"], {"day": row["day"], **empty_rollup()}), row)
+        add_rollup(by_company.setdefault(row["company_id"], {
+            "company_id": row["company_id"],
+            "company_name": row.get("company_name"),
+            **empty_rollup()
+        }), row)
+        add_rollup(by_area.setdefault(row["delivery_area"], {"delivery_area": row["delivery_area"], **empty_rollup()}), row)
+
+    return {
+        "from": date_from,
+        "to": date_to,
+        "totals": totals,
+        "by_day": sorted(by_day.values(), key=lambda x: x["day"]),
+        "by_company": list(by_company.values()),
+        "by_area": list(by_area.values())
+    }
+
+@api_router.get("/admission/stats")
+async def get_admission_stats(current_user: dict = Depends(get_current_user)):
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Admin only")
+
+    return admission.snapshot()
+
+@api_router.get("/history/queue-stats")
+async def get_history_queue_stats(current_user: dict = Depends(get_current_user)):
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Admin only")
+
+    return {"enabled": HISTORY_WRITE_BEHIND, **history_log.snapshot()}
+
 # Company Management Routes (Admin only)
 @api_router.get("/companies")
-async def get_companies(current_user: dict = Depends(get_current_user)):
+async def get_companies(request: Request, response: Response, current_user: dict = Depends(get_current_user)):
     if current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Admin only")
-    
-    companies = await db.users.find({"role": "company"}, {"_id": 0, "password_hash": 0}).to_list(1000)
-    
-    # Convert ISO strings to datetime
-    for company in companies:
-        if isinstance(company.get('created_at'), str):
-            company['created_at'] = datetime.fromisoformat(company['created_at'])
-    
-    return companies
+
+    # The body must match the ETag: a directory loaded under an older
+    # version (e.g. before another worker's register) is reloaded
+    version = await data_version(COMPANIES_VERSION)
+    etag = format_etag(COMPANIES_VERSION, version)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    set_etag(response, etag)
+
+    return await company_directory.all(version=version)
 
 @api_router.delete("/companies/{company_id}")
 async def delete_company(company_id: str, current_user: dict = Depends(get_current_user)):
@@ -659,6 +2160,9 @@ async def delete_company(company_id: str, current_user: dict = Depends(get_curre
     
     # Only delete company user account (keep orders for archive)
     await db.users.delete_one({"id": company_id})
+    invalidate_user(company_id)
+    company_directory.invalidate()
+    await bump_versions(COMPANIES_VERSION)
     
     return {"message": f"تم حذف حساب شركة {company['company_name']} بنجاح. الطلبات محفوظة في الأرشيف"}
 
@@ -678,8 +2182,9 @@ async def reset_company_password(company_id: str, current_user: dict = Depends(g
     new_password = ''.join(secrets.choice(string.ascii_letters + string.digits) for _ in range(10))
     
     # Update password
-    new_hash = hash_password(new_password)
+    new_hash = await run_password_task(hash_password, new_password)
     await db.users.update_one({"id": company_id}, {"$set": {"password_hash": new_hash}})
+    invalidate_user(company_id)
     
     return {
         "message": f"تم إعادة تعيين كلمة المرور لشركة {company['company_name']}",
@@ -709,8 +2214,17 @@ app.add_middleware(
     allow_credentials=True,  # required to send cookies
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Sync-Token", "ETag", "X-Search-Truncated"],
 )
 
+# Compress JSON and exports above COMPRESS_MIN_BYTES; brotli when
+# brotli-asgi is installed and the client accepts it, gzip otherwise
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "1024"))
+if BrotliMiddleware is not None:
+    app.add_middleware(BrotliMiddleware, minimum_size=COMPRESS_MIN_BYTES, gzip_fallback=True)
+else:
+    app.add_middleware(GZipMiddleware, minimum_size=COMPRESS_MIN_BYTES)
+
 # Include router
 app.include_router(api_router)
 
@@ -724,16 +2238,250 @@ app.include_router(api_router)
 # )
 
 
+# ============= Indexes =============
+
+# (collection, keys, unique) for every index the hot queries rely on
+INDEXES = [
+    ("users", [("id", 1)], True),
+    ("users", [("username", 1)], True),
+    ("users", [("company_name", 1)], False),
+    ("users", [("role", 1)], False),
+    ("orders", [("id", 1)], True),
+    ("orders", [("company_id", 1), ("created_at", -1), ("id", -1)], False),
+    ("orders", [("created_at", -1), ("id", -1)], False),
+    ("orders", [("status", 1), ("created_at", 1)], False),
+    ("orders", [("company_id", 1), ("updated_at", 1), ("id", 1)], False),
+    ("orders", [("updated_at", 1), ("id", 1)], False),
+    ("orders", [("company_id", 1), ("search_terms", 1)], False),
+    ("orders", [("search_terms", 1)], False),
+    ("order_history", [("order_id", 1), ("timestamp", -1), ("id", -1)], False),
+    ("daily_rollups", [("day", 1), ("company_id", 1), ("delivery_area", 1)], True),
+    ("daily_rollups", [("company_id", 1), ("day", 1)], False),
+    ("order_history", [("action", 1), ("timestamp", 1)], False),
+    ("orders_archive", [("id", 1)], True),
+    ("orders_archive", [("company_id", 1), ("created_at", -1), ("id", -1)], False),
+    ("orders_archive", [("created_at", -1), ("id", -1)], False),
+    ("orders_archive", [("status", 1), ("created_at", 1)], False),
+    ("orders_archive", [("company_id", 1), ("search_terms", 1)], False),
+    ("orders_archive", [("search_terms", 1)], False),
+    ("orders_archive", [("company_id", 1), ("archived_at", 1)], False),
+    ("orders_archive", [("archived_at", 1)], False),
+    ("report_cache", [("day", 1)], False),
+]
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
+async def ensure_indexes():
+    # create_index is a no-op when the index already exists
+    for collection, keys, unique in INDEXES:
+        try:
+            await db[collection].create_index(keys, unique=unique)
+        except DuplicateKeyError:
+            # Existing data has duplicates, fall back to a plain index
+            logger.warning("Duplicate values in %s %s, creating non-unique index", collection, keys)
+            await db[collection].create_index(keys)
+
+def index_check_queries() -> list[tuple[str, str, dict, list]]:
+    # (route, collection, filter, sort) shaped like the queries each route runs
+    sample_id = str(uuid.uuid4())
+    day_start = datetime.combine(datetime.now(timezone.utc), time.min).replace(tzinfo=timezone.utc)
+    day_end = datetime.combine(datetime.now(timezone.utc), time.max).replace(tzinfo=timezone.utc)
+    newest_first = [("created_at", -1), ("id", -1)]
+    return [
+        ("get_current_user", "users", {"id": sample_id}, []),
+        ("login", "users", {"username": "index-check"}, []),
+        ("create_order (admin)", "users", {"company_name": "index-check"}, []),
+        ("get_companies", "users", {"role": "company"}, []),
+        ("get_orders (company)", "orders", {"company_id": sample_id}, newest_first),
+        ("get_orders (admin, paginated)", "orders", {}, newest_first),
+        ("update_order / delete_order", "orders", {"id": sample_id}, []),
+        ("get_report", "orders", {"status": {"$in": ["تم", "ملغي"]}, "created_at": {"$gte": day_start, "$lte": day_end}}, []),
+        ("get_order_history", "order_history", {"order_id": sample_id}, [("timestamp", -1), ("id", -1)]),
+        ("get_order_history_batch", "order_history", {"order_id": {"$in": [sample_id]}}, [("order_id", 1), ("timestamp", -1), ("id", -1)]),
+        ("search_orders (company)", "orders", {"company_id": sample_id, **search_query("محمد")}, []),
+        ("search_orders (admin)", "orders", search_query("0791"), []),
+        ("get_order_changes (company)", "orders", {"company_id": sample_id, "updated_at": {"$gte": day_start}}, [("updated_at", 1), ("id", 1)]),
+        ("get_order_changes (admin)", "orders", {"updated_at": {"$gte": day_start}}, [("updated_at", 1), ("id", 1)]),
+        ("get_report_summary (admin)", "daily_rollups", {"day": {"$gte": "2025-01-01", "$lte": "2025-01-31"}}, []),
+        ("get_report_summary (company)", "daily_rollups", {"company_id": sample_id, "day": {"$gte": "2025-01-01", "$lte": "2025-01-31"}}, []),
+        ("get_order_changes (tombstones)", "order_history", {"action": "deleted", "timestamp": {"$gte": day_start}}, []),
+        ("get_order_changes (archived, company)", "orders_archive", {"company_id": sample_id, "archived_at": {"$gte": day_start}}, []),
+        ("get_order_changes (archived, admin)", "orders_archive", {"archived_at": {"$gte": day_start}}, []),
+        ("get_report (archive)", "orders_archive", {"status": {"$in": ["تم", "ملغي"]}, "created_at": {"$gte": day_start, "$lte": day_end}}, []),
+        ("search_orders (archive, company)", "orders_archive", {"company_id": sample_id, **search_query("محمد")}, []),
+        ("search_orders (archive, admin)", "orders_archive", search_query("0791"), []),
+        ("export_orders (archive)", "orders_archive", {"company_id": sample_id}, [("created_at", 1), ("id", 1)]),
+        ("archive_orders", "orders", {"status": {"$in": ["تم", "ملغي"]}, "created_at": {"$lt": day_start}}, []),
+    ]
+
+def index_check_pipelines() -> list[tuple[str, str, list]]:
+    # (route, collection, pipeline) for the routes that aggregate
+    sample_id = str(uuid.uuid4())
+    pipelines = []
+    if not USE_STATS_COUNTERS:
+        # Without counters, admin /stats groups the whole hot tier; this
+        # entry fails until USE_STATS_COUNTERS replaces it with one read
+        pipelines += [
+            ("get_stats (company)", "orders", stats_pipeline({"company_id": sample_id})),
+            ("get_stats (admin)", "orders", stats_pipeline({})),
+        ]
+    return pipelines
+
+def index_check_count() -> int:
+    return len(index_check_queries()) + len(index_check_pipelines())
+
+def _winning_plans(explain):
+    # Aggregation explains nest a queryPlanner per pushed-down stage
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == "winningPlan":
+                yield value
+            else:
+                yield from _winning_plans(value)
+    elif isinstance(explain, list):
+        for value in explain:
+            yield from _winning_plans(value)
+
+def _plan_has_collscan(plan) -> bool:
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            return True
+        return any(_plan_has_collscan(value) for value in plan.values())
+    if isinstance(plan, list):
+        return any(_plan_has_collscan(value) for value in plan)
+    return False
+
+async def check_index_usage() -> list[str]:
+    # Returns the routes whose winning plan falls back to a collection scan
+    failures = []
+    for route, collection, query, sort in index_check_queries():
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = await cursor.limit(1).explain()
+        if _plan_has_collscan(plan.get("queryPlanner", {}).get("winningPlan")):
+            failures.append(f"{route}: COLLSCAN on {collection} for {query}")
+    for route, collection, pipeline in index_check_pipelines():
+        explain = await db.command("aggregate", collection, pipeline=pipeline, explain=True)
+        if any(_plan_has_collscan(plan) for plan in _winning_plans(explain)):
+            failures.append(f"{route}: COLLSCAN on {collection} for {pipeline[0]}")
+    return failures
+
+# ============= Lifespan Steps =============
+
+READY_PING_TIMEOUT = float(os.environ.get("READY_PING_TIMEOUT", "2"))
+WS_DRAIN_SECONDS = float(os.environ.get("WS_DRAIN_SECONDS", "5"))
+# How long /readyz fails before draining starts: at least one probe period
+SHUTDOWN_GRACE_SECONDS = float(os.environ.get("SHUTDOWN_GRACE_SECONDS", "5"))
+
+async def connect_mongo():
+    # Fail startup if Mongo stays unreachable, then open minPoolSize
+    # connections up front so the first requests don't pay for the handshakes
+    for attempt in range(1, MONGO_STARTUP_RETRIES + 1):
+        try:
+            await client.admin.command("ping")
+            break
+        except Exception as e:
+            if attempt == MONGO_STARTUP_RETRIES:
+                raise RuntimeError(f"MongoDB unreachable after {attempt} attempts") from e
+            logger.warning("MongoDB ping failed (attempt %d/%d): %s", attempt, MONGO_STARTUP_RETRIES, e)
+            await asyncio.sleep(min(2 ** attempt, 10))
+    await asyncio.gather(*(client.admin.command("ping") for _ in range(MONGO_MIN_POOL_SIZE)))
+    logger.info("MongoDB connected, pool warmed with %d connections", MONGO_MIN_POOL_SIZE)
+
+async def create_indexes():
+    await ensure_indexes()
+
+    if os.environ.get("CHECK_INDEXES", "").lower() in ("1", "true", "yes"):
+        failures = await check_index_usage()
+        if failures:
+            raise RuntimeError("Queries without index support:\n" + "\n".join(failures))
+        logger.info("Index check passed for %d route queries", index_check_count())
+
+async def build_order_counters():
+    # First start with counters enabled: build them from the orders collection
+    if USE_STATS_COUNTERS and not await db.order_counters.find_one({"_id": ALL_COMPANIES}):
+        companies = await reconcile_order_counters()
+        logger.info("Order counters built for %d companies", companies)
+    # Archived before archive_counters existed
+    if not await db.archive_counters.find_one({"_id": ALL_COMPANIES}) and await db.orders_archive.find_one({}):
+        await refresh_archive_counters()
+        logger.info("Archive counters built")
+
+async def build_search_terms():
+    # Orders written before search_terms existed are invisible to search;
+    # the (search_terms) index answers the $exists: false probe
+    missing = {"search_terms": {"$exists": False}}
+    if any([await db[collection].find_one(missing, {"_id": 1}) for collection in ORDER_TIERS]):
+        updated = await rebuild_search_terms(only_missing=True)
+        logger.info("Search terms backfilled on %d orders", updated)
+
+async def start_hub():
+    await hub.start()
+
+async def build_daily_rollups():
+    # Backfill once when rollups are introduced on an existing database;
+    # with several workers starting, one builds and the others skip
+    if not await db.daily_rollups.find_one({}) and await db.orders.find_one({}):
+        rollups = await rebuild_daily_rollups(only_if_empty=True)
+        if rollups is not None:
+            logger.info("Daily rollups built: %d documents", rollups)
+
+async def stop_hub():
+    await hub.stop(code=1012, spread=WS_DRAIN_SECONDS)
+
+# uvicorn's shutdown closes the listeners and fails every websocket before
+# the lifespan shutdown runs, so a drain there finds no one left. Its
+# SIGTERM/SIGINT handlers are wrapped instead: the first signal fails
+# /readyz and refuses new websockets, waits SHUTDOWN_GRACE_SECONDS for the
+# load balancer to notice, drains the hub, and only then passes the signal
+# on to uvicorn. A second signal passes straight through.
+drain_task = None
+
+def install_drain_handlers():
+    # Signal handlers can only be set from the main thread; test clients
+    # run the app elsewhere and keep the lifespan drain
+    if threading.current_thread() is not threading.main_thread():
+        return
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        previous = signal.getsignal(sig)
+        # Only wrap a server's handler, not the interpreter defaults
+        if not callable(previous) or previous is signal.default_int_handler:
+            continue
+
+        def handler(signum, frame, previous=previous):
+            if drain_task is not None:
+                previous(signum, frame)
+                return
+            loop.call_soon_threadsafe(start_drain, previous, signum)
+
+        signal.signal(sig, handler)
+
+def start_drain(previous, signum: int):
+    global drain_task
+    if drain_task is None:
+        drain_task = asyncio.get_running_loop().create_task(drain_before_exit(previous, signum))
+
+async def drain_before_exit(previous, signum: int):
+    try:
+        app.state.ready = False
+        hub.draining = True
+        logger.info("Draining: readiness failed, closing websockets in %.1fs", SHUTDOWN_GRACE_SECONDS)
+        await asyncio.sleep(SHUTDOWN_GRACE_SECONDS)
+        await stop_hub()
+    finally:
+        previous(signum, None)
+
+async def start_history_log():
+    if HISTORY_WRITE_BEHIND:
+        await history_log.start()
+
+async def drain_history_log():
+    # Flush queued history before the Mongo client closes
+    await history_log.stop()
 
-@app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
+    password_executor.shutdown(wait=False, cancel_futures=True)
 
 # Create default admin on startup
 # @app.on_event("startup")
@@ -0,0 +1,97 @@
+import argparse
+import asyncio
+import sys
+
+import main
+
+
+async def ensure_indexes(args):
+    await main.ensure_indexes()
+    print("Indexes created")
+
+
+async def check_indexes(args):
+    await main.ensure_indexes()
+    failures = await main.check_index_usage()
+    for failure in failures:
+        print("FAIL", failure)
+    if failures:
+        sys.exit(1)
+    print(f"OK: {main.index_check_count()} route queries use an index")
+
+
+async def reconcile_stats(args):
+    companies = await main.reconcile_order_counters()
+    await main.refresh_archive_counters()
+    # Corrected counts must not hide behind /stats ETags already handed out
+    await main.db.data_versions.update_many({}, {"$inc": {"version": 1}})
+    print(f"Order counters rebuilt for {companies} companies")
+
+
+async def rebuild_rollups(args):
+    rollups = await main.rebuild_daily_rollups()
+    if rollups is None:
+        print("FAIL Another rollup rebuild is in progress")
+        sys.exit(1)
+    print(f"Daily rollups rebuilt: {rollups} documents")
+
+
+async def migrate_datetimes(args):
+    for collection, field in main.DATETIME_FIELDS:
+        converted, failed = await main.migrate_datetime_field(collection, field, args.batch_size)
+        print(f"{collection}.{field}: {converted} converted, {failed} unparseable")
+    # Serialized dates changed: invalidate every ETag handed out so far
+    await main.db.data_versions.update_many({}, {"$inc": {"version": 1}})
+    # Reports cached while created_at was a string missed those orders
+    await main.clear_report_cache()
+
+
+async def rebuild_search(args):
+    updated = await main.rebuild_search_terms(args.batch_size)
+    print(f"Search terms updated on {updated} orders")
+
+
+async def archive_orders(args):
+    try:
+        result = await main.archive_orders(args.older_than_days, args.batch_size)
+    except RuntimeError as e:
+        print("FAIL", e)
+        sys.exit(1)
+    print(f"Archived {result['moved']} orders ({result['deleted_companies']} deleted companies), "
+          f"{result['skipped']} skipped because they changed mid-run")
+
+
+COMMANDS = {
+    "ensure-indexes": ensure_indexes,
+    "check-indexes": check_indexes,
+    "reconcile-stats": reconcile_stats,
+    "rebuild-rollups": rebuild_rollups,
+    "migrate-datetimes": migrate_datetimes,
+    "rebuild-search": rebuild_search,
+    "archive-orders": archive_orders,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="VPerfumes backend maintenance commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("ensure-indexes", help="Create the indexes the API relies on")
+    subparsers.add_parser("check-indexes", help="Explain every route query and fail on COLLSCAN")
+    subparsers.add_parser("reconcile-stats", help="Rebuild the /stats order counters from the orders collection")
+    subparsers.add_parser("rebuild-rollups", help="Rebuild daily_rollups from the orders collection")
+    migrate = subparsers.add_parser("migrate-datetimes", help="Convert ISO-string datetimes to BSON dates")
+    migrate.add_argument("--batch-size", type=int, default=1000)
+    search = subparsers.add_parser("rebuild-search", help="Backfill the normalized search_terms on every order")
+    search.add_argument("--batch-size", type=int, default=1000)
+    archive = subparsers.add_parser("archive-orders", help="Move old finished orders and orders of deleted companies to orders_archive")
+    archive.add_argument("--older-than-days", type=int, default=main.ARCHIVE_AFTER_DAYS)
+    archive.add_argument("--batch-size", type=int, default=500)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    try:
+        asyncio.run(COMMANDS[args.command](args))
+    finally:
+        main.client.close()
@@ -0,0 +1,208 @@
+import threading
+import time
+from bisect import bisect_left
+
+from pymongo import monitoring
+
+# Seconds; covers cache hits through slow aggregations
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+# ============= Metric types =============
+# Minimal Prometheus text-format metrics. Observations may come from pymongo's
+# monitoring threads, so every update takes the metric's lock.
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in values.items():
+            yield f"{self.name}{_labels(self.label_names, labels)} {value}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+
+class CallbackGauge:
+    # Gauge read from the owning component at scrape time
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, callback):
+        self.name = name
+        self.help = help
+        self.callback = callback
+
+    def samples(self):
+        yield f"{self.name} {self.callback()}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.buckets = buckets
+        # labels -> [count per bucket..., +Inf count, sum]
+        self._series: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def samples(self):
+        with self._lock:
+            snapshot = {labels: list(series) for labels, series in self._series.items()}
+        for labels, series in snapshot.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = _labels(self.label_names, labels, 'le="%s"' % bound)
+                yield f"{self.name}_bucket{le} {cumulative}"
+            cumulative += series[-2]
+            le = _labels(self.label_names, labels, 'le="+Inf"')
+            yield f"{self.name}_bucket{le} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.label_names, labels)} {series[-1]}"
+            yield f"{self.name}_count{_labels(self.label_names, labels)} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: tuple = ()) -> Gauge:
+        return self.register(Gauge(name, help, labels))
+
+    def callback_gauge(self, name: str, help: str, callback) -> CallbackGauge:
+        return self.register(CallbackGauge(name, help, callback))
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.counter(
+    "http_requests_total", "HTTP requests by route template and status", ("method", "route", "status"))
+http_latency = registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template", ("method", "route"))
+http_in_flight = registry.gauge(
+    "http_requests_in_flight", "HTTP requests currently being served", ("method",))
+mongo_latency = registry.histogram(
+    "mongodb_command_duration_seconds", "MongoDB command latency", ("collection", "operation"))
+mongo_failures = registry.counter(
+    "mongodb_command_failures_total", "Failed MongoDB commands", ("collection", "operation"))
+
+
+# ============= HTTP =============
+
+class MetricsMiddleware:
+    # ASGI middleware timing every HTTP request. The route label is the matched
+    # path template (/api/orders/{order_id}), never the raw path, so series
+    # stay bounded; unmatched requests share one label.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        http_in_flight.inc(method)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            http_in_flight.dec(method)
+            route = scope.get("route")
+            template = getattr(route, "path", None) or "unmatched"
+            http_latency.observe(elapsed, method, template)
+            http_requests.inc(method, template, str(status_code))
+
+
+# ============= MongoDB =============
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    # pymongo reports the command name and body only on start, so the labels
+    # are kept per request id until the matching success or failure event.
+    def __init__(self):
+        self._pending: dict[tuple, tuple] = {}
+
+    @staticmethod
+    def _collection(event) -> str:
+        value = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            value = event.command.get("collection")
+        return value if isinstance(value, str) else "-"
+
+    def started(self, event):
+        self._pending[(event.connection_id, event.request_id)] = (self._collection(event), event.command_name)
+
+    def succeeded(self, event):
+        labels = self._pending.pop((event.connection_id, event.request_id), ("-", event.command_name))
+        mongo_latency.observe(event.duration_micros / 1e6, *labels)
+
+    def failed(self, event):
+        labels = self._pending.pop((event.connection_id, event.request_id), ("-", event.command_name))
+        mongo_latency.observe(event.duration_micros / 1e6, *labels)
+        mongo_failures.inc(*labels)
@@ -0,0 +1,283 @@
+import asyncio
+import logging
+import uuid
+from collections import deque
+from datetime import datetime, timezone
+from typing import Optional
+
+from fastapi import WebSocket
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+
+# ============= Brokers =============
+# A broker carries published events to the hub of every worker process.
+# start() receives the hub's deliver callback, publish() sends an event.
+
+class InProcessBroker:
+    # Single worker: events go straight to the local hub
+    def __init__(self):
+        self._deliver = None
+
+    async def start(self, deliver):
+        self._deliver = deliver
+
+    async def publish(self, channel: str, message: dict):
+        await self._deliver(channel, message)
+
+    async def stop(self):
+        pass
+
+
+class MongoChangeStreamBroker:
+    # Several workers: events are inserted into a shared collection and every
+    # worker tails it with a change stream (needs a replica set, a
+    # single-node one is enough). Local subscribers are served directly.
+    def __init__(self, collection, retention_seconds: int = 300):
+        self.collection = collection
+        self.retention_seconds = retention_seconds
+        self.origin = str(uuid.uuid4())
+        self._deliver = None
+        self._task = None
+
+    async def start(self, deliver):
+        self._deliver = deliver
+        await self.collection.create_index("created_at", expireAfterSeconds=self.retention_seconds)
+        self._task = asyncio.create_task(self._watch())
+
+    async def publish(self, channel: str, message: dict):
+        await self._deliver(channel, message)
+        await self.collection.insert_one({
+            "origin": self.origin,
+            "channel": channel,
+            "message": message,
+            "created_at": datetime.now(timezone.utc),
+        })
+
+    async def _watch(self):
+        pipeline = [{"$match": {"operationType": "insert", "fullDocument.origin": {"$ne": self.origin}}}]
+        resume_token = None
+        while True:
+            try:
+                async with self.collection.watch(pipeline, resume_after=resume_token) as stream:
+                    async for change in stream:
+                        resume_token = stream.resume_token
+                        event = change["fullDocument"]
+                        await self._deliver(event["channel"], event["message"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Change stream interrupted, reconnecting: %s", e)
+                await asyncio.sleep(1)
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+# ============= Sequencers =============
+# A sequencer numbers the events of each channel 1, 2, 3, ... within an
+# epoch. A client that comes back from a different epoch (restart, reset)
+# cannot be replayed and is told to resync.
+
+class InProcessSequencer:
+    # Single worker: numbering restarts, under a new epoch, with the process
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex[:8]
+        self.seqs: dict[str, int] = {}
+
+    async def next(self, channel: str) -> tuple[int, str]:
+        self.seqs[channel] = self.seqs.get(channel, 0) + 1
+        return self.seqs[channel], self.epoch
+
+    async def current(self, channel: str) -> tuple[int, Optional[str]]:
+        return self.seqs.get(channel, 0), self.epoch
+
+
+class MongoSequencer:
+    # Several workers: one $inc counter document per channel
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def next(self, channel: str) -> tuple[int, str]:
+        doc = await self.collection.find_one_and_update(
+            {"_id": channel},
+            {"$inc": {"seq": 1}, "$setOnInsert": {"epoch": uuid.uuid4().hex[:8]}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return doc["seq"], doc["epoch"]
+
+    async def current(self, channel: str) -> tuple[int, Optional[str]]:
+        doc = await self.collection.find_one({"_id": channel})
+        return (doc["seq"], doc["epoch"]) if doc else (0, None)
+
+
+# ============= Hub =============
+
+class Subscriber:
+    def __init__(self, channel: str, websocket: WebSocket, queue_size: int):
+        self.channel = channel
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.task = None
+
+
+class BroadcastHub:
+    # Fan-out of events to websocket subscribers grouped by channel (company id).
+    # Each subscriber has its own bounded queue and sender task, so a publish
+    # never waits on a socket; a subscriber whose queue fills up or whose send
+    # times out is disconnected.
+    #
+    # Every event gets a per-channel sequence number and is kept in a ring
+    # buffer of the last replay_size events, so a client reconnecting with
+    # the last seq it saw gets what it missed, or a "resync" frame when the
+    # buffer no longer covers the gap. Events queued for one subscriber
+    # within batch_window seconds go out as one {"type": "batch"} frame.
+    def __init__(self, broker, sequencer, queue_size: int = 100, send_timeout: float = 5.0,
+                 replay_size: int = 256, batch_window: float = 0.01, max_batch: int = 100):
+        self.broker = broker
+        self.sequencer = sequencer
+        self.queue_size = queue_size
+        self.send_timeout = send_timeout
+        self.replay_size = replay_size
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.channels: dict[str, set[Subscriber]] = {}
+        self.buffers: dict[str, deque] = {}
+        self.draining = False
+        self.stats = {"sent": 0, "send_failures": 0, "dropped_slow": 0, "batches": 0, "replayed": 0, "resyncs": 0}
+
+    async def start(self):
+        await self.broker.start(self._deliver)
+
+    async def stop(self, code: int = 1012, spread: float = 0.0):
+        # Graceful drain: refuse new subscribers, let each one's queued events
+        # go out, then close it with a close frame (1012: service restart).
+        # Closes are spread over `spread` seconds so clients reconnecting to
+        # the remaining workers don't all arrive at once.
+        self.draining = True
+        await self.broker.stop()
+        subscribers = [s for subs in self.channels.values() for s in subs]
+        delay = spread / len(subscribers) if subscribers else 0
+        for subscriber in subscribers:
+            try:
+                await asyncio.wait_for(subscriber.queue.join(), self.send_timeout)
+            except asyncio.TimeoutError:
+                pass
+            await self.disconnect(subscriber, code=code)
+            if delay:
+                await asyncio.sleep(delay)
+
+    def connection_count(self) -> int:
+        return sum(len(subs) for subs in self.channels.values())
+
+    async def connect(self, channel: str, websocket: WebSocket,
+                      last_seq: Optional[int] = None, epoch: Optional[str] = None) -> Subscriber:
+        current, current_epoch = await self.sequencer.current(channel)
+
+        # No await from here on: everything up to the buffer snapshot is
+        # replayed, everything delivered later lands in the queue
+        subscriber = Subscriber(channel, websocket, self.queue_size)
+        self.channels.setdefault(channel, set()).add(subscriber)
+        buffered = list(self.buffers.get(channel, ()))
+        latest = max([current] + [event["seq"] for event in buffered])
+
+        if last_seq is None:
+            first = [{"type": "hello", "seq": latest, "epoch": current_epoch}]
+        else:
+            missed = sorted((e for e in buffered if e["seq"] > last_seq), key=lambda e: e["seq"])
+            stale = (epoch is not None and current_epoch is not None and epoch != current_epoch) or last_seq > latest
+            if stale or [e["seq"] for e in missed] != list(range(last_seq + 1, latest + 1)):
+                self.stats["resyncs"] += 1
+                first = [{"type": "resync", "seq": latest, "epoch": current_epoch}]
+            else:
+                self.stats["replayed"] += len(missed)
+                first = [self._frame(missed[i:i + self.max_batch]) for i in range(0, len(missed), self.max_batch)]
+
+        subscriber.task = asyncio.create_task(self._sender(subscriber, first))
+        return subscriber
+
+    async def disconnect(self, subscriber: Subscriber, code: int = 1000):
+        subs = self.channels.get(subscriber.channel)
+        if subs is None or subscriber not in subs:
+            return
+        subs.discard(subscriber)
+        if not subs:
+            del self.channels[subscriber.channel]
+
+        if subscriber.task is not asyncio.current_task():
+            subscriber.task.cancel()
+        try:
+            await subscriber.websocket.close(code=code)
+        except Exception:
+            pass
+
+    async def publish(self, channel: str, event: dict):
+        seq, epoch = await self.sequencer.next(channel)
+        await self.broker.publish(channel, {**event, "seq": seq, "epoch": epoch})
+
+    async def _deliver(self, channel: str, message: dict):
+        buffer = self.buffers.get(channel)
+        if buffer is None:
+            buffer = self.buffers[channel] = deque(maxlen=self.replay_size)
+        buffer.append(message)
+        for subscriber in list(self.channels.get(channel, ())):
+            try:
+                subscriber.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                self.stats["dropped_slow"] += 1
+                logger.warning("Dropping slow websocket subscriber on %s", channel)
+                # 1013: try again later
+                asyncio.create_task(self.disconnect(subscriber, code=1013))
+
+    @staticmethod
+    def _frame(events: list) -> dict:
+        return events[0] if len(events) == 1 else {"type": "batch", "events": events}
+
+    async def _collect(self, subscriber: Subscriber) -> list:
+        # First event, plus whatever else arrives within batch_window
+        loop = asyncio.get_running_loop()
+        events = [await subscriber.queue.get()]
+        deadline = loop.time() + self.batch_window
+        while len(events) < self.max_batch:
+            if subscriber.queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    events.append(await asyncio.wait_for(subscriber.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            else:
+                events.append(subscriber.queue.get_nowait())
+        return events
+
+    async def _send(self, subscriber: Subscriber, frame: dict) -> bool:
+        try:
+            await asyncio.wait_for(subscriber.websocket.send_json(frame), self.send_timeout)
+            self.stats["sent"] += 1
+            return True
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.stats["send_failures"] += 1
+            await self.disconnect(subscriber, code=1011)
+            return False
+
+    async def _sender(self, subscriber: Subscriber, first: list):
+        for frame in first:
+            if not await self._send(subscriber, frame):
+                return
+        while True:
+            events = await self._collect(subscriber)
+            try:
+                if len(events) > 1:
+                    self.stats["batches"] += 1
+                if not await self._send(subscriber, self._frame(events)):
+                    return
+            finally:
+                for _ in events:
+                    subscriber.queue.task_done()
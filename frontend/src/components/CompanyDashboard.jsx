@@ -79,32 +79,79 @@ export default function CompanyDashboard({ onSettings }) {
       return;
     }
     let ws;
+    let closedByUs = false;
+    let retryDelay = 1000;
+    let retryTimer = null;
+    // Last event applied; sent on reconnect so the server replays what we missed
+    let lastSeq = null;
+    let epoch = null;
 
     fetchOrders();
     fetchStats();
 
-    ws = new WebSocket(`${WS_BASE}/ws/orders/${user.id}`);
-    wsRef.current = ws;
-
-    ws.onopen = () => {
-      console.log("WS connected for company:", user.id);
-    };
-
-    ws.onmessage = (event) => {
-      const data = JSON.parse(event.data);
+    const applyEvent = (data) => {
       if (data.type === "new_order") {
         toast.warning("هنالك طلب جديد");
         setOrders((prev) => [data.order, ...prev]);
+      } else if (data.type === "new_orders") {
+        toast.warning(`هنالك ${data.orders.length} طلبات جديدة`);
+        setOrders((prev) => [...data.orders, ...prev]);
+      } else if (data.type === "order_updated") {
+        setOrders((prev) =>
+          prev.map((o) => (o.id === data.order.id ? data.order : o))
+        );
+      } else if (data.type === "order_deleted") {
+        setOrders((prev) => prev.filter((o) => o.id !== data.order_id));
       }
     };
 
-    ws.onerror = (e) => {
-      console.error("WS error", e);
+    const connect = () => {
+      const resume =
+        lastSeq !== null
+          ? `?last_seq=${lastSeq}${epoch ? `&epoch=${epoch}` : ""}`
+          : "";
+      ws = new WebSocket(`${WS_BASE}/ws/orders/${user.id}${resume}`);
+      wsRef.current = ws;
+
+      ws.onopen = () => {
+        console.log("WS connected for company:", user.id);
+        retryDelay = 1000;
+      };
+
+      ws.onmessage = (event) => {
+        const data = JSON.parse(event.data);
+        if (data.type === "hello" || data.type === "resync") {
+          // resync: too much was missed to replay, reload instead
+          if (data.type === "resync") {
+            fetchOrders();
+          }
+          lastSeq = data.seq;
+          epoch = data.epoch;
+          return;
+        }
+        const events = data.type === "batch" ? data.events : [data];
+        events.forEach((e) => {
+          applyEvent(e);
+          lastSeq = e.seq;
+          epoch = e.epoch;
+        });
+        fetchStats();
+      };
+
+      ws.onerror = (e) => {
+        console.error("WS error", e);
+      };
+
+      ws.onclose = () => {
+        console.log("WS closed");
+        if (closedByUs) return;
+        // Back off, with jitter so a restarted server isn't hit all at once
+        retryTimer = setTimeout(connect, retryDelay * (0.5 + Math.random()));
+        retryDelay = Math.min(retryDelay * 2, 30000);
+      };
     };
 
-    ws.onclose = () => {
-      console.log("WS closed");
-    };
+    connect();
 
     const handleResize = () => {
       if (window.innerWidth >= 768) {
@@ -117,6 +164,8 @@ export default function CompanyDashboard({ onSettings }) {
     window.addEventListener("resize", handleResize);
 
     return () => {
+      closedByUs = true;
+      clearTimeout(retryTimer);
       if (wsRef.current) {
         wsRef.current.close();
         wsRef.current = null;